@@ -6,6 +6,14 @@ from fractions import Fraction
 from pygame import display
 from pygame.locals import *
 from SceneParser import *
+from Scene import Scene
+from Camera import Viewport, Camera
+from BVH import HEURISTICS
+from Termination import Termination
+from Checkpoint import DTYPES
+from Supersampling import DEFAULT_THRESHOLD
+from Distributed import parse_address, is_loopback
+from RenderCache import DEFAULT_DIR, DEFAULT_SIZE
 import pygame
 
 class App:
@@ -25,19 +33,70 @@ class App:
         parser.add_argument('-f', help="Fullscreen mode", action='store_true')
         parser.add_argument('-s', help="Save as a screenshot after completion", action='store_true')
         parser.add_argument('-hm', help="Runs the software in headless mode", action='store_true')
+        parser.add_argument('-workers', metavar='n', type=int, help="Render tiles on n worker processes", default=0)
+        parser.add_argument('-coordinator', metavar='host:port', type=str, help="Hand the tiles to workers on other machines (python Distributed.py host:port), with -workers also start that many on this one")
+        parser.add_argument('-authkey', type=str, help="With -coordinator, the secret the workers have to know, defaults to $RT_AUTHKEY or a random one for the workers of -workers")
+        parser.add_argument('-bvh', type=str, choices=HEURISTICS, help="Build a BVH over the spheres and lights with the given split heuristic")
+        parser.add_argument('-progressive', help="Render a coarse preview first and refine it over a few passes", action='store_true')
+        parser.add_argument('-profile', help="Print ray and intersection counters after every render", action='store_true')
+        parser.add_argument('-heatmap', metavar='path', type=str, help="With -profile, save an image of the ray cost per tile to path")
+        parser.add_argument('-batch', help="Render whole batches of rays at once with the vectorized NumPy renderer", action='store_true')
+        parser.add_argument('-epsilon', metavar='e', type=float, help="Stop following a reflection once it can't change a color channel by more than e", default=0.0)
+        parser.add_argument('-roulette', metavar='r', type=float, help="Russian roulette for reflections that can't change a color channel by more than r", default=0.0)
+        parser.add_argument('-lighterror', metavar='e', type=float, help="Cull and cluster the lights of every hit, changing a color channel by at most e per bounce", default=0.0)
+        parser.add_argument('-shadowmap', metavar='r', type=int, help="Precompute an r x r cube shadow map for every light when the scene is loaded, shadow rays are only traced at the edges of shadows", default=0)
+        parser.add_argument('-aa', metavar='n', type=int, help="Anti-alias the edges of a finished frame by tracing n x n rays for each pixel on one", default=1)
+        parser.add_argument('-aathreshold', metavar='t', type=float, help="With -aa, also counts pixels whose color is more than t off from a neighbour as an edge", default=DEFAULT_THRESHOLD)
+        parser.add_argument('-frametime', metavar='ms', type=float, help="While the camera moves, lower the resolution and reflection depth to render a frame in about ms milliseconds, at full quality again once it stops", default=0.0)
+        parser.add_argument('-reproject', help="When the camera moves, start from the last frame moved to the new view and trace the pixels it doesn't cover first", action='store_true')
+        parser.add_argument('-checkpoint', metavar='path', type=str, help="With -hm, render into a memory mapped .npy file that an interrupted render resumes from")
+        parser.add_argument('-ctype', type=str, choices=DTYPES, help="Pixel type of the -checkpoint file", default='float32')
+        parser.add_argument('-cache', metavar='dir', type=str, nargs='?', const=DEFAULT_DIR, help="Keep finished frames in dir (default %s) and load them instead of rendering the same frame again" % DEFAULT_DIR)
+        parser.add_argument('-cachesize', metavar='mb', type=int, help="Size limit of the -cache directory, the least recently used frames go first", default=DEFAULT_SIZE)
         
         args = parser.parse_args()
+        if args.checkpoint and not args.hm:
+            parser.error("-checkpoint only works in headless mode (-hm)")
+        if args.checkpoint and args.aa > 1:
+            parser.error("-aa can't be combined with -checkpoint, a resumed render doesn't know the hits of the pixels it skipped")
+        if args.shadowmap and args.lighterror:
+            parser.error("-shadowmap can't be combined with -lighterror, the shadow maps are made for the lights and not for their clusters")
+        authkey = args.authkey or os.environ.get('RT_AUTHKEY')
+        if args.coordinator and not authkey and not is_loopback(parse_address(args.coordinator)[0]):
+            parser.error("-coordinator on an address other machines can reach needs -authkey or $RT_AUTHKEY, whoever connects to it could run code on it")
+        if args.checkpoint and args.cache:
+            parser.error("-cache can't be combined with -checkpoint, which keeps the frame on disk already")
         
         self.max_depth = args.max
+        self.bvh = args.bvh
+        self.light_error = args.lighterror
+        self.shadow_resolution = args.shadowmap
         
         self.scene_path = args.scene if args.scene else None
         self.scene = load_scene_file(self.scene_path) if self.scene_path else Scene(default=True)
+        self.compile_scene()
         if self.scene_path:
             self.last_stamp = os.stat(self.scene_path).st_mtime
 
         self.fullscreen = args.f
         self.screenshot = args.s
         self.headless = args.hm
+        self.batch = args.batch
+        self.workers = args.workers
+        self.coordinator = parse_address(args.coordinator) if args.coordinator else None
+        self.authkey = authkey.encode() if authkey else None
+        self.progressive = args.progressive
+        self.profile = args.profile or args.heatmap is not None
+        self.heatmap = args.heatmap
+        self.termination = Termination(args.epsilon, args.roulette)
+        self.samples = args.aa
+        self.aa_threshold = args.aathreshold
+        self.reproject = args.reproject
+        self.frame_time = args.frametime / 1000 # seconds, 0 renders every frame at full quality
+        self.checkpoint = args.checkpoint
+        self.checkpoint_type = args.ctype
+        self.cache = args.cache
+        self.cache_size = args.cachesize
 
         self.viewport_width = args.width
         self.viewport_height = args.height
@@ -115,69 +174,25 @@ class App:
         camera.z = normalize(camera.position - camera.look_to)
         return (True, camera)
 
+    def compile_scene(self):
+        # done once per loaded scene, camera movement reuses the compiled scene and its BVH
+        compiled = self.scene.compile(self.bvh, self.light_error, self.shadow_resolution)
+        if compiled.bvh:
+            print(compiled.bvh.report())
+        if compiled.light_tree:
+            print(compiled.light_tree.report())
+        if compiled.shadow_maps:
+            print(compiled.shadow_maps.report())
+
     def check_for_scene_update(self):
         if self.scene_path:
             new_stamp = os.stat(self.scene_path).st_mtime
             if new_stamp != self.last_stamp:
                 self.last_stamp = new_stamp
                 self.scene = load_scene_file(self.scene_path)
+                self.compile_scene()
                 return True
             else:
                 return False
         else:
             return False
-
-
-class Scene:
-    def __init__(self, default):
-        self.objects = []
-        self.lights = []
-        
-        # default init
-        if default:
-            print("Loading default scene")
-            self.add_object(Sphere(center=(-9.0, 3.2, -12.0), radius=4.0, material=Material(1.0, (255, 0,0))))
-            self.add_object(Sphere(center=(-0.5, 2.0, -8.0), radius=3.0, material=Material(1.0, (0, 255, 0))))
-            self.add_object(Sphere(center=(4.0, 1.0, -6.0), radius=2.0, material=Material(1.0, (0, 0, 255))))
-            self.add_object(Sphere(center=(5.0, 0.0, -3.0), radius=1.0, material=Material(1.0, (255, 255, 0))))
-            
-            self.add_object(Plane(origin=(0.0, -1.0 , 0.0), normal=(0, 1, 0), material=Material(1.0, None)))
-    
-            self.add_light(Light(position=(6.0, 4.0, -3.0), intensity=10.0, material=Material(0.0, (255,255,255))))
-            self.add_light(Light(position=(0.0, 4.0, 0.0), intensity=7.0, material=Material(0.0, (255,255,255))))
-        
-    def add_object(self, obj):
-        self.objects.append(obj)
-
-    def add_light(self, light):
-        self.lights.append(light)
-
-    def get_all_scene_objects(self):
-        return self.lights + self.objects
-
-class Viewport:
-    def __init__(self,  aspect_ratio, image_width, image_height):
-        # we want the viewport to have the same aspect ratio as the image itself
-        # the viewport ranges from -1 to 1 in the x-axis
-        # and -1/aspect_ratio to 1/aspect_ratio in the y-axis
-        # these numbers are arbitrary, but it's a common thing to do
-        self.width = 1
-        self.height = (1.0 / aspect_ratio)
-
-        viewport = (-self.width, -self.height, self.width, self.height) # LEFT, BOTTOM, RIGHT, TOP
-        
-        self.coordinates = [np.linspace(viewport[1], viewport[3], image_height), np.linspace(viewport[0], viewport[2], image_width)]
-        
-class Camera:
-    def __init__(self, position, look_to, image_width, image_height):
-        
-        self.position = np.array(position)
-        self.look_to = np.array(look_to)
-        self.up = np.array([0.0, 1.0, 0.0])
-        
-        self.z = normalize(self.position - self.look_to) # unit vector at where we are looking
-        self.x = normalize(np.cross(self.up, self.z))
-        self.y = normalize(np.cross(self.z, self.x))
-
-        aspect_ratio = image_width//image_height
-        self.viewport = Viewport(aspect_ratio, image_width, image_height)
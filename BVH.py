@@ -0,0 +1,371 @@
+import numpy as np
+from time import perf_counter
+
+from Ray import Hit
+from CompiledScene import LIGHT, intersect_spheres
+import Profiler
+
+# Bounding volume hierarchy over the bounded primitives of a CompiledScene (spheres and lights).
+# Planes are unbounded, so they don't go into the tree and are still tested against every ray.
+# The tree is stored flattened in arrays: an inner node points at its two children,
+# a leaf points at a range of the primitive order array.
+
+LEAF_SIZE = 4
+SAH_BINS = 12
+HEURISTICS = ('sah', 'median')
+
+class BVH:
+    def __init__(self, compiled, heuristic='sah', leaf_size=LEAF_SIZE):
+        start_counter = perf_counter()
+
+        self.compiled = compiled
+        self.heuristic = heuristic
+        self.leaf_size = leaf_size
+
+        # primitives, lights first like the object IDs
+        self.ids = np.concatenate([compiled.light_ids, compiled.sphere_ids])
+        self.centers = np.concatenate([compiled.light_positions, compiled.sphere_centers]).reshape((-1, 3))
+        self.radii = np.concatenate([compiled.light_radii, compiled.sphere_radii])
+        self.is_light = compiled.object_type[self.ids] == LIGHT
+
+        self.build()
+
+        self.build_time = perf_counter() - start_counter
+        self.reset_stats()
+
+    def build(self):
+        bounds_min = self.centers - self.radii[:, None]
+        bounds_max = self.centers + self.radii[:, None]
+
+        order = np.arange(len(self.ids))
+        node_min, node_max = [], []
+        node_left, node_right = [], [] # child indices, -1 for leaves
+        node_start, node_count = [], [] # range in order for leaves
+
+        def new_node():
+            node_min.append(None)
+            node_max.append(None)
+            node_left.append(-1)
+            node_right.append(-1)
+            node_start.append(0)
+            node_count.append(0)
+            return len(node_min) - 1
+
+        self.depth = 0
+        stack = [(new_node(), 0, len(order), 1)] if len(order) else []
+        while stack:
+            node, start, end, depth = stack.pop()
+            self.depth = max(self.depth, depth)
+            prims = order[start:end]
+
+            node_min[node] = bounds_min[prims].min(axis=0)
+            node_max[node] = bounds_max[prims].max(axis=0)
+
+            split = self.split(prims, bounds_min, bounds_max, node_min[node], node_max[node])
+            if split is None:
+                node_start[node] = start
+                node_count[node] = end - start
+                continue
+
+            order[start:end] = prims[split[0]]
+            mid = start + split[1]
+
+            node_left[node] = new_node()
+            node_right[node] = new_node()
+            stack.append((node_left[node], start, mid, depth + 1))
+            stack.append((node_right[node], mid, end, depth + 1))
+
+        self.order = order
+        self.node_min = np.array(node_min).reshape((-1, 3))
+        self.node_max = np.array(node_max).reshape((-1, 3))
+        self.node_left = np.array(node_left, dtype=np.int64)
+        self.node_right = np.array(node_right, dtype=np.int64)
+        self.node_start = np.array(node_start, dtype=np.int64)
+        self.node_count = np.array(node_count, dtype=np.int64)
+
+        # plain python copies for the scalar traversal, indexing lists is a lot faster than indexing arrays one at a time
+        self.node_list = list(zip(self.node_min.tolist(), self.node_max.tolist(), node_left, node_right, node_start, node_count))
+        self.prim_list = list(zip(self.ids[order].tolist(), self.is_light[order].tolist()))
+
+    def split(self, prims, bounds_min, bounds_max, box_min, box_max):
+        # returns (permutation of prims, size of the left half) or None if prims should become a leaf
+        count = len(prims)
+        if count <= self.leaf_size:
+            return None
+
+        centroids = self.centers[prims]
+        extent = centroids.max(axis=0) - centroids.min(axis=0)
+        if not extent.any():
+            # every centroid is in the same spot, any split is as good as another
+            return np.arange(count), count // 2
+
+        if self.heuristic == 'median':
+            axis = np.argmax(extent)
+            permutation = np.argsort(centroids[:, axis], kind='stable')
+            return permutation, count // 2
+
+        # binned surface area heuristic, all three axes are binned at once
+        low = centroids.min(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bins = np.nan_to_num((centroids - low) / extent * SAH_BINS).astype(np.int64)
+        bins = np.minimum(bins, SAH_BINS - 1)
+        flat_bins = (bins + np.arange(3) * SAH_BINS).ravel() # one row of bins per axis
+
+        bin_count = np.bincount(flat_bins, minlength=3 * SAH_BINS).reshape((3, SAH_BINS))
+        bin_min = np.full((3 * SAH_BINS, 3), np.inf)
+        bin_max = np.full((3 * SAH_BINS, 3), -np.inf)
+        np.minimum.at(bin_min, flat_bins, np.repeat(bounds_min[prims], 3, axis=0))
+        np.maximum.at(bin_max, flat_bins, np.repeat(bounds_max[prims], 3, axis=0))
+        bin_min = bin_min.reshape((3, SAH_BINS, 3))
+        bin_max = bin_max.reshape((3, SAH_BINS, 3))
+
+        # sweep from both sides, split i puts bins [0, i] to the left
+        left_count = np.cumsum(bin_count, axis=1)[:, :-1]
+        right_count = np.cumsum(bin_count[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        left_area = surface_area(np.minimum.accumulate(bin_min, axis=1)[:, :-1], np.maximum.accumulate(bin_max, axis=1)[:, :-1])
+        right_area = surface_area(np.minimum.accumulate(bin_min[:, ::-1], axis=1)[:, ::-1][:, 1:],
+                                  np.maximum.accumulate(bin_max[:, ::-1], axis=1)[:, ::-1][:, 1:])
+
+        with np.errstate(invalid='ignore'):
+            cost = np.where((left_count > 0) & (right_count > 0), left_count * left_area + right_count * right_area, np.inf)
+
+        best_axis, best_bin = np.unravel_index(np.argmin(cost), cost.shape)
+        best_cost = cost[best_axis, best_bin]
+
+        # compare against not splitting at all, the traversal of one node costs about as much as one intersection test
+        area = surface_area(box_min, box_max)
+        if area + best_cost >= count * area and count <= 4 * self.leaf_size:
+            return None
+
+        left = bins[:, best_axis] <= best_bin
+        permutation = np.concatenate([np.flatnonzero(left), np.flatnonzero(~left)])
+        return permutation, int(left.sum())
+
+    def reset_stats(self):
+        self.rays = 0
+        self.node_visits = 0
+        self.primitive_tests = 0
+
+    def report(self):
+        rays = max(1, self.rays)
+        return ("BVH ({0}): {1} primitives, {2} nodes, depth {3}, built in {4:.3f} seconds\n"
+                "BVH traversal: {5} rays, {6:.2f} nodes and {7:.2f} primitive tests per ray").format(
+                    self.heuristic, len(self.ids), len(self.node_list), self.depth, self.build_time,
+                    self.rays, self.node_visits / rays, self.primitive_tests / rays)
+
+    def trace_ray(self, ray, lights=True):
+        # scalar traversal used by Ray.py, returns the nearest Hit (planes included) or None
+        scene_objects = self.compiled.scene_objects
+        nearest_solution = np.inf
+        nearest_geometry = -1
+
+        self.rays += 1
+        if self.node_list:
+            ox, oy, oz = ray.origin
+            inv = [1.0 / d if d != 0 else np.inf for d in ray.direction]
+
+            stack = [0]
+            while stack:
+                bmin, bmax, left, right, start, count = self.node_list[stack.pop()]
+                self.node_visits += 1
+
+                if not hit_box(ox, oy, oz, inv, bmin, bmax, nearest_solution):
+                    continue
+
+                if left < 0:
+                    for idx, is_light in self.prim_list[start:start + count]:
+                        if is_light and not lights:
+                            continue
+
+                        self.primitive_tests += 1
+                        if Profiler.active:
+                            Profiler.active.tests['Light' if is_light else 'Sphere'] += 1
+                        solution = scene_objects[idx].intersect_test(ray)
+                        if solution and (solution < nearest_solution or (solution == nearest_solution and idx < nearest_geometry)):
+                            nearest_solution = solution
+                            nearest_geometry = idx
+                else:
+                    stack.append(right)
+                    stack.append(left)
+
+        # planes are unbounded, test them all
+        if Profiler.active:
+            Profiler.active.tests['Plane'] += len(self.compiled.plane_ids)
+
+        for idx in self.compiled.plane_ids.tolist():
+            solution = scene_objects[idx].intersect_test(ray)
+            if solution and (solution < nearest_solution or (solution == nearest_solution and idx < nearest_geometry)):
+                nearest_solution = solution
+                nearest_geometry = idx
+
+        if nearest_geometry >= 0:
+            return Hit(nearest_solution, scene_objects[nearest_geometry], ray.intersection(nearest_solution))
+
+        return None
+
+    def find_occluder(self, ray, max_distance, skip=None):
+        # scalar any-hit traversal for shadow rays, returns the first object (planes included, lights excluded)
+        # that the ray hits before max_distance or None, boxes further away than that are never entered
+        # skip is an object that is already known to miss
+        scene_objects = self.compiled.scene_objects
+
+        self.rays += 1
+        if self.node_list:
+            ox, oy, oz = ray.origin
+            inv = [1.0 / d if d != 0 else np.inf for d in ray.direction]
+
+            stack = [0]
+            while stack:
+                bmin, bmax, left, right, start, count = self.node_list[stack.pop()]
+                self.node_visits += 1
+
+                if not hit_box(ox, oy, oz, inv, bmin, bmax, max_distance):
+                    continue
+
+                if left < 0:
+                    for idx, is_light in self.prim_list[start:start + count]:
+                        if is_light or scene_objects[idx] is skip:
+                            continue
+
+                        self.primitive_tests += 1
+                        if Profiler.active:
+                            Profiler.active.tests['Sphere'] += 1
+                        if scene_objects[idx].occludes(ray, max_distance):
+                            return scene_objects[idx]
+                else:
+                    stack.append(right)
+                    stack.append(left)
+
+        for idx in self.compiled.plane_ids.tolist():
+            if scene_objects[idx] is skip:
+                continue
+            if Profiler.active:
+                Profiler.active.tests['Plane'] += 1
+            if scene_objects[idx].occludes(ray, max_distance):
+                return scene_objects[idx]
+
+        return None
+
+    def intersect(self, origins, directions, lights=True):
+        # batched traversal, every node is visited with the subset of rays that hit its box
+        # returns the nearest distances and object IDs (-1 for no hit) of the bounded primitives
+        nearest_solution = np.full(len(origins), np.inf)
+        nearest_geometry = np.full(len(origins), -1)
+
+        self.rays += len(origins)
+        if not self.node_list:
+            return nearest_solution, nearest_geometry
+
+        with np.errstate(divide='ignore'):
+            inv = 1.0 / directions
+
+        stack = [(0, np.arange(len(origins)))]
+        while stack:
+            node, rays = stack.pop()
+            self.node_visits += len(rays)
+
+            rays = rays[hit_boxes(origins[rays], inv[rays], self.node_min[node], self.node_max[node], nearest_solution[rays])]
+            if len(rays) == 0:
+                continue
+
+            if self.node_left[node] >= 0:
+                stack.append((self.node_right[node], rays))
+                stack.append((self.node_left[node], rays))
+                continue
+
+            prims = self.order[self.node_start[node]:self.node_start[node] + self.node_count[node]]
+            if not lights:
+                prims = prims[~self.is_light[prims]]
+                if len(prims) == 0:
+                    continue
+
+            self.primitive_tests += len(rays) * len(prims)
+            if Profiler.active:
+                lights_tested = int(self.is_light[prims].sum())
+                Profiler.active.tests['Light'] += len(rays) * lights_tested
+                Profiler.active.tests['Sphere'] += len(rays) * (len(prims) - lights_tested)
+            solutions = intersect_spheres(origins[rays], directions[rays], self.centers[prims], self.radii[prims])
+            ids = self.ids[prims]
+            for i, idx in enumerate(ids):
+                solution = solutions[:, i]
+                best = nearest_solution[rays]
+                closer = (solution < best) | ((solution == best) & (idx < nearest_geometry[rays]) & (solution < np.inf))
+                nearest_solution[rays[closer]] = solution[closer]
+                nearest_geometry[rays[closer]] = idx
+
+        return nearest_solution, nearest_geometry
+
+    def occluded(self, origins, directions, max_distances):
+        # batched any-hit traversal for shadow rays, whether each ray hits a sphere before its max distance
+        # a ray is dropped from the traversal as soon as anything blocks it
+        occluded = np.zeros(len(origins), dtype=bool)
+
+        self.rays += len(origins)
+        if not self.node_list:
+            return occluded
+
+        with np.errstate(divide='ignore'):
+            inv = 1.0 / directions
+
+        stack = [(0, np.arange(len(origins)))]
+        while stack:
+            node, rays = stack.pop()
+            rays = rays[~occluded[rays]]
+            self.node_visits += len(rays)
+
+            rays = rays[hit_boxes(origins[rays], inv[rays], self.node_min[node], self.node_max[node], max_distances[rays])]
+            if len(rays) == 0:
+                continue
+
+            if self.node_left[node] >= 0:
+                stack.append((self.node_right[node], rays))
+                stack.append((self.node_left[node], rays))
+                continue
+
+            prims = self.order[self.node_start[node]:self.node_start[node] + self.node_count[node]]
+            prims = prims[~self.is_light[prims]]
+            if len(prims) == 0:
+                continue
+
+            self.primitive_tests += len(rays) * len(prims)
+            if Profiler.active:
+                Profiler.active.tests['Sphere'] += len(rays) * len(prims)
+            solutions = intersect_spheres(origins[rays], directions[rays], self.centers[prims], self.radii[prims])
+            occluded[rays[(solutions < max_distances[rays, None]).any(axis=1)]] = True
+
+        return occluded
+
+def surface_area(box_min, box_max):
+    size = np.maximum(box_max - box_min, 0)
+    return 2 * (size[..., 0] * size[..., 1] + size[..., 1] * size[..., 2] + size[..., 2] * size[..., 0])
+
+def hit_box(ox, oy, oz, inv, bmin, bmax, max_distance):
+    # slab test for a single ray, plain floats only
+    t_near, t_far = 0.0, max_distance
+    for o, i, low, high in ((ox, inv[0], bmin[0], bmax[0]), (oy, inv[1], bmin[1], bmax[1]), (oz, inv[2], bmin[2], bmax[2])):
+        if i == np.inf:
+            # parallel to the slab, the origin has to be inside it
+            if o < low or o > high:
+                return False
+            continue
+
+        t1 = (low - o) * i
+        t2 = (high - o) * i
+        if t1 > t2:
+            t1, t2 = t2, t1
+        t_near = max(t_near, t1)
+        t_far = min(t_far, t2)
+        if t_near > t_far:
+            return False
+
+    return True
+
+def hit_boxes(origins, inv, bmin, bmax, max_distance):
+    # slab test for many rays against one box, fmin/fmax ignore the NaNs of 0 * inf
+    with np.errstate(invalid='ignore'):
+        t1 = (bmin - origins) * inv
+        t2 = (bmax - origins) * inv
+
+    t_near = np.fmax(np.fmin(t1, t2).max(axis=1), 0)
+    t_far = np.fmin(np.fmax(t1, t2).min(axis=1), max_distance)
+    return t_near <= t_far
@@ -0,0 +1,220 @@
+import numpy as np
+from time import perf_counter
+from utility import *
+from Termination import DEFAULT_TERMINATION
+import Profiler
+
+# Vectorized version of the renderer in Ray.py.
+# Instead of tracing one pixel at a time, every ray of a batch is stored as a row in an (N, 3) array
+# and each step (intersection, shading, shadows, reflections) is done for the whole batch at once.
+# The math follows Ray.py exactly so both paths produce the same image.
+
+# Amount of rays traced in one go when rendering a frame, keeps the temporary arrays reasonably small
+BATCH_SIZE = 1 << 16
+
+# shadow visibility is recorded as one bit per light, for this many lights at most
+VISIBILITY_BITS = 64
+
+def primary_rays(x, y, camera):
+    # same as calculate_pixel, but for flat arrays of viewport coordinates
+    pixels = np.stack([x, -y, np.zeros(len(x))], axis=1)
+    directions = normalize_batch(pixels - camera.z)
+    origins = np.broadcast_to(camera.position, directions.shape).astype(float)
+    return origins, directions
+
+def shade_batch(origins, directions, distances, geometry, compiled, visible=None, throughput=None):
+    # computes everything compute_color does for a single bounce:
+    # the nudged intersection points, their normals, the surface colors, the light contribution and the reflection factor,
+    # which lights reach each point as a bit mask (bit i for light i) and the amount of shadow rays traced for each point
+    # visible takes such bit masks from an earlier trace, then no shadow rays are traced at all
+    # throughput is the one of every path, the light tree (see LightTree.py) culls more lights on paths that can't add much
+    intersections = origins + directions * distances[:, None]
+    normals = compiled.get_normals(intersections, geometry)
+    colors = compiled.get_colors(intersections, geometry)
+    reflection = compiled.reflection[geometry]
+
+    intersections_moved = intersections + (1e-7 * normals)
+
+    replay = visible is not None
+    if not replay:
+        visible = np.zeros(len(origins), dtype=np.uint64)
+
+    lightning = np.zeros(len(origins))
+    shadows = np.zeros(len(origins), dtype=np.int64)
+    profiler = Profiler.active
+    tree = compiled.light_tree
+
+    if tree is not None and not replay:
+        # all the shadow rays towards the clusters at once, then their light is added up per point in the order of select
+        rays, clusters = tree.select_batch(intersections_moved, np.ones(len(origins)) if throughput is None else throughput)
+        l_dir = tree.positions[clusters] - intersections_moved[rays]
+        l_length = length_batch(l_dir)
+
+        if profiler:
+            start = perf_counter()
+
+        lit = ~compiled.occluded(intersections_moved[rays], normalize_batch(l_dir), l_length)
+
+        if profiler:
+            profiler.add_time('shadow', start)
+            profiler.shadow_rays += len(rays)
+
+        shadows += np.bincount(rays, minlength=len(origins))
+        np.bitwise_or.at(visible, rays[lit], tree.bits[clusters[lit]])
+        np.add.at(lightning, rays[lit], tree.intensities[clusters[lit]] / (4*np.pi*np.sqrt(l_length[lit])))
+        return intersections_moved, normals, colors, reflection, lightning, visible, shadows
+
+    maps = compiled.shadow_maps # see ShadowMap.py, only the points it's unsure about trace shadow rays
+    for light, (position, intensity) in enumerate(zip(compiled.light_positions, compiled.light_intensities)):
+        l_dir = position - intersections_moved
+        l_length = length_batch(l_dir)
+        bit = np.uint64(1 << light) if light < VISIBILITY_BITS else None
+
+        if replay:
+            lit = (visible & bit) != 0
+        else:
+            # shadows
+            if profiler:
+                start = perf_counter()
+
+            if maps is not None:
+                lit, shadowed = maps.lookup(light, intersections_moved, l_length, geometry)
+                traced = np.flatnonzero(~(lit | shadowed))
+                lit[traced] = ~compiled.occluded(intersections_moved[traced], normalize_batch(l_dir[traced]), l_length[traced])
+                shadows[traced] += 1
+            else:
+                lit = ~compiled.occluded(intersections_moved, normalize_batch(l_dir), l_length)
+                shadows += 1
+
+            if profiler:
+                profiler.add_time('shadow', start)
+                traced_rays = len(traced) if maps is not None else len(origins)
+                profiler.shadow_rays += traced_rays
+                profiler.shadow_lookups += len(origins) - traced_rays
+
+            if bit is not None:
+                visible[lit] |= bit
+
+        lightning[lit] += intensity / (4*np.pi*np.sqrt(l_length[lit])) # Inverse-square law
+
+    return intersections_moved, normals, colors, reflection, lightning, visible, shadows
+
+def compute_color_batch(origins, directions, compiled, depth, cost=None, paths=None, replay=False, termination=None, candidates=None):
+    # cost is an optional array that receives the amount of rays traced for every primary ray
+    # paths is an optional tuple of (N, depth + 1) arrays that receive the object ID, the distance and the visible lights
+    # of every hit along a path, they are expected to be filled with -1, inf and 0 beforehand (see PathBuffer.py)
+    # with replay the paths are read instead: nothing is traced and only the shading is done again,
+    # which gives the same image as long as the geometry and the light positions didn't change
+    # termination decides when a path isn't worth following any further, see Termination.py
+    # candidates is an optional array of the only object IDs the primary rays can hit, see ScreenBins.py
+    termination = termination or DEFAULT_TERMINATION
+    limit = termination.limit(compiled.lights)
+
+    color = np.zeros((len(origins), 3))
+    throughput = np.ones(len(origins))
+    active = np.arange(len(origins)) # indices of the rays that are still bouncing around
+
+    if paths:
+        path_ids, path_distances, path_visible = paths
+
+    profiler = Profiler.active if not replay else None
+    if profiler:
+        profiler.primary_rays += len(origins)
+        bounces = np.zeros(len(origins), dtype=np.int64) # reflection rays per path
+        shadows = np.zeros(len(origins), dtype=np.int64) # shadow rays per path
+        start = perf_counter()
+
+    if replay:
+        distances, geometry = path_distances[:, 0], path_ids[:, 0]
+    else:
+        distances, geometry = compiled.intersect(origins, directions, candidates=candidates)
+    hit = geometry >= 0
+    primary_hit = hit
+
+    if profiler:
+        profiler.add_time('primary', start)
+
+    if paths and not replay:
+        path_ids[:, 0], path_distances[:, 0] = geometry, distances
+
+    # like in compute_color every bounce is weighted by the product of reflection * lightning of all previous bounces,
+    # which we carry along as the throughput
+    for bounce in range(depth + 1):
+        # compact the batch so only rays that hit something are shaded
+        active, origins, directions = active[hit], origins[hit], directions[hit]
+        distances, geometry, throughput = distances[hit], geometry[hit], throughput[hit]
+
+        if len(active) == 0:
+            break
+
+        visible = path_visible[active, bounce] if replay else None
+        points, normals, colors, reflection, lightning, visible, shadow_rays = shade_batch(origins, directions, distances, geometry, compiled,
+                                                                                         visible, throughput)
+        color[active] += colors * (throughput * lightning)[:, None]
+
+        if paths and not replay:
+            path_visible[active, bounce] = visible
+
+        if profiler:
+            shadows[active] += shadow_rays
+
+        if bounce == depth:
+            break
+
+        throughput = throughput * reflection * lightning
+        if not replay:
+            # a replay follows the recorded paths, which already ended where they were terminated
+            going, throughput = termination.apply(throughput, limit)
+            active, throughput, points, normals = active[going], throughput[going], points[going], normals[going]
+
+        origins = points
+        directions = normalize_batch(reflect_batch(points, normals))
+
+        if profiler:
+            profiler.reflection_rays += len(origins)
+            bounces[active] += 1
+            start = perf_counter()
+
+        if replay:
+            distances, geometry = path_distances[active, bounce + 1], path_ids[active, bounce + 1]
+        else:
+            distances, geometry = compiled.intersect(origins, directions)
+        hit = geometry >= 0
+
+        if profiler:
+            profiler.add_time('reflection', start)
+
+        if paths and not replay:
+            path_ids[active, bounce + 1], path_distances[active, bounce + 1] = geometry, distances
+
+    if profiler:
+        profiler.depths.update(dict(enumerate(np.bincount(bounces).tolist())))
+        if cost is not None:
+            cost += 1 + bounces + shadows
+
+    color[primary_hit] = np.clip(color[primary_hit], 0, 255)
+    return color
+
+def render_coordinates(x, y, camera, scene, depth, cost=None, paths=None, replay=False, termination=None, candidates=None):
+    # renders arbitrary viewport coordinates, returns an (N, 3) array of colors
+    compiled = scene.compile()
+    color = np.zeros((len(x), 3))
+    for start in range(0, len(x), BATCH_SIZE):
+        end = start + BATCH_SIZE
+        origins, directions = primary_rays(x[start:end], y[start:end], camera)
+        color[start:end] = compute_color_batch(origins, directions, compiled, depth, None if cost is None else cost[start:end],
+                                               paths and tuple(array[start:end] for array in paths), replay, termination, candidates)
+
+    return color
+
+def render_rows(camera, scene, depth, y_start, y_end):
+    # renders rows [y_start, y_end) of the viewport, the result is indexed as [x, y] like the backbuffer
+    xs = camera.viewport.coordinates[1]
+    ys = camera.viewport.coordinates[0][y_start:y_end]
+    x, y = np.meshgrid(xs, ys, indexing='ij')
+
+    color = render_coordinates(x.ravel(), y.ravel(), camera, scene, depth)
+    return color.reshape((len(xs), len(ys), 3))
+
+def render_frame(camera, scene, depth):
+    return render_rows(camera, scene, depth, 0, len(camera.viewport.coordinates[0]))
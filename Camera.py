@@ -0,0 +1,29 @@
+import numpy as np
+from utility import *
+
+class Viewport:
+    def __init__(self,  aspect_ratio, image_width, image_height):
+        # we want the viewport to have the same aspect ratio as the image itself
+        # the viewport ranges from -1 to 1 in the x-axis
+        # and -1/aspect_ratio to 1/aspect_ratio in the y-axis
+        # these numbers are arbitrary, but it's a common thing to do
+        self.width = 1
+        self.height = (1.0 / aspect_ratio)
+
+        viewport = (-self.width, -self.height, self.width, self.height) # LEFT, BOTTOM, RIGHT, TOP
+        
+        self.coordinates = [np.linspace(viewport[1], viewport[3], image_height), np.linspace(viewport[0], viewport[2], image_width)]
+        
+class Camera:
+    def __init__(self, position, look_to, image_width, image_height):
+        
+        self.position = np.array(position)
+        self.look_to = np.array(look_to)
+        self.up = np.array([0.0, 1.0, 0.0])
+        
+        self.z = normalize(self.position - self.look_to) # unit vector at where we are looking
+        self.x = normalize(np.cross(self.up, self.z))
+        self.y = normalize(np.cross(self.z, self.x))
+
+        aspect_ratio = image_width//image_height
+        self.viewport = Viewport(aspect_ratio, image_width, image_height)
@@ -0,0 +1,68 @@
+import json
+import os
+import numpy as np
+
+# A backbuffer that lives in a file instead of in memory, for renders that take too long to lose or are too big for RAM.
+# The pixels are a memory mapped .npy file (float32 or uint8, instead of the float64 of the in-memory backbuffer),
+# and every region (block of rows or tile) the renderer finishes is appended to a log next to it, after its pixels are flushed.
+# Opening the same file again with the same render settings picks up the log, and remaining() tells the renderer
+# which pixels are left, so an interrupted render resumes where it stopped.
+
+DTYPES = ('float32', 'uint8')
+
+class Checkpoint:
+    def __init__(self, path, width, height, dtype, settings):
+        # settings is anything JSON can store that decides what the image looks like (scene, camera, depth...),
+        # a file that was rendered with other settings is started over
+        self.path = path
+        self.log_path = path + ".progress"
+        self.done = np.zeros((width, height), dtype=bool)
+        header = json.dumps({"width": width, "height": height, "dtype": dtype, "settings": settings}, sort_keys=True)
+
+        self.resumed = self.resume(header)
+        if not self.resumed:
+            self.done[:] = False # resume might have gotten through the log before failing
+            self.pixels = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(width, height, 3))
+            with open(self.log_path, 'w') as log:
+                log.write(header + "\n")
+
+        self.log = open(self.log_path, 'a')
+
+    def resume(self, header):
+        # loads the pixels and the finished regions of an earlier render with the same header, returns whether there was one
+        try:
+            with open(self.log_path) as log:
+                if log.readline().rstrip("\n") != header:
+                    return False
+
+                for line in log:
+                    region = line.split()
+                    if len(region) == 4: # the last line might have been cut off
+                        x_start, x_end, y_start, y_end = [int(value) for value in region]
+                        self.done[x_start:x_end, y_start:y_end] = True
+
+            self.pixels = np.load(self.path, mmap_mode='r+')
+            return True
+
+        except (OSError, ValueError):
+            return False
+
+    def remaining(self):
+        # (width, height) mask of the pixels that still have to be rendered
+        return ~self.done
+
+    def finish(self, region):
+        # called with every region the renderer has written, the pixels hit the disk before the log says they're done
+        x_start, x_end, y_start, y_end = region
+        self.pixels.flush()
+        self.done[x_start:x_end, y_start:y_end] = True
+        self.log.write("%d %d %d %d\n" % region)
+        self.log.flush()
+        os.fsync(self.log.fileno())
+
+    def complete(self):
+        return self.done.all()
+
+    def close(self):
+        self.pixels.flush()
+        self.log.close()
@@ -0,0 +1,253 @@
+import numpy as np
+from utility import *
+from Intersectable import *
+import Profiler
+
+# A Scene flattened into contiguous arrays (struct of arrays).
+# Every object gets an ID which is its index in scene.get_all_scene_objects(), i.e. lights first and then the objects,
+# so the same object wins a tie here as in intersect_objects. Per object data (type, material) is indexed by ID,
+# while the geometry is stored per primitive type so a whole group can be intersected at once.
+
+LIGHT = 0
+SPHERE = 1
+PLANE = 2
+TYPE_NAMES = ('Light', 'Sphere', 'Plane')
+
+# upper limit of rays * primitives that are intersected in one go, keeps the (N, S) temporaries small
+CHUNK_SIZE = 1 << 20
+
+class CompiledScene:
+    def __init__(self, scene):
+        self.scene = scene
+        self.lights = scene.lights
+        table = scene.object_table()
+        count = len(self.lights) + len(table['type'])
+
+        self.object_type = np.empty(count, dtype=np.int8)
+        self.centers = np.zeros((count, 3)) # sphere/light centers and plane origins
+        self.normals = np.zeros((count, 3)) # normalized plane normals
+        self.radii = np.zeros(count) # sphere/light radii
+
+        # material table
+        self.reflection = np.zeros(count)
+        self.colors = np.zeros((count, 3))
+        self.checker = np.zeros(count, dtype=bool)
+
+        for idx, light in enumerate(self.lights):
+            light.id = idx
+            self.object_type[idx] = LIGHT
+            self.centers[idx] = light.origin
+            self.radii[idx] = light.radius
+            self.reflection[idx] = light.material.reflection
+            if light.material.color is not None:
+                self.colors[idx] = light.material.color
+
+        # the objects come as a table already (see object_table), so they're copied over a column at a time
+        objects = slice(len(self.lights), count)
+        self.object_type[objects] = table['type']
+        self.centers[objects] = table['centers']
+        self.radii[objects] = table['radii']
+        self.reflection[objects] = table['reflection']
+        self.colors[objects] = table['colors']
+        self.checker[objects] = table['checker']
+        scene.number_objects(len(self.lights))
+
+        # geometry per primitive type, the *_ids arrays map back to object IDs
+        self.light_ids = np.flatnonzero(self.object_type == LIGHT)
+        self.light_positions = self.centers[self.light_ids]
+        self.light_radii = self.radii[self.light_ids]
+        self.light_intensities = np.array([light.intensity for light in self.lights])
+
+        self.sphere_ids = np.flatnonzero(self.object_type == SPHERE)
+        self.sphere_centers = self.centers[self.sphere_ids]
+        self.sphere_radii = self.radii[self.sphere_ids]
+
+        self.plane_ids = np.flatnonzero(self.object_type == PLANE)
+        self.plane_origins = self.centers[self.plane_ids]
+        self.plane_normals = table['normals'][self.plane_ids - len(self.lights)]
+        for idx, normal in zip(self.plane_ids, self.plane_normals):
+            self.normals[idx] = normalize(normal)
+
+        # optional acceleration structure over the spheres and lights, see BVH.py
+        self.bvh = None
+        # optional culling and clustering of the lights, see LightTree.py
+        self.light_tree = None
+        # optional precomputed shadows of the lights, see ShadowMap.py
+        self.shadow_maps = None
+
+    @property
+    def scene_objects(self):
+        # the objects by ID, only the scalar code needs them so they're made on first use for a scene loaded from a file
+        return self.scene.get_all_scene_objects()
+
+    def signatures(self):
+        # everything that decides how an object looks as one tuple per object ID,
+        # two objects with the same signature render the same (see PathBuffer.diff_scenes)
+        intensities = np.zeros(len(self.object_type))
+        intensities[self.light_ids] = self.light_intensities
+
+        table = np.column_stack([self.object_type, self.centers, self.normals, self.radii, intensities, self.reflection, self.colors, self.checker])
+        return [tuple(row) for row in table.tolist()]
+
+    def intersect(self, origins, directions, lights=True, candidates=None):
+        # nearest hit for every ray, returns the distances and the object IDs (-1 for no hit)
+        # lights=False only tests scene.objects
+        # candidates is an optional array of the only object IDs the rays can hit (see ScreenBins.py), then the BVH isn't used
+        nearest_solution = np.full(len(origins), np.inf)
+        nearest_geometry = np.full(len(origins), -1)
+
+        groups = [(self.sphere_ids, intersect_spheres, (self.sphere_centers, self.sphere_radii)),
+                  (self.plane_ids, intersect_planes, (self.plane_origins,))]
+        if lights:
+            groups.insert(0, (self.light_ids, intersect_spheres, (self.light_positions, self.light_radii)))
+
+        if candidates is not None:
+            groups = [(ids[keep], kernel, tuple(array[keep] for array in arrays))
+                      for ids, kernel, arrays in groups for keep in [np.isin(ids, candidates)]]
+        elif self.bvh is not None:
+            # the BVH takes care of spheres and lights, only the unbounded planes are left
+            nearest_solution, nearest_geometry = self.bvh.intersect(origins, directions, lights)
+            groups = groups[-1:]
+
+        for ids, kernel, arrays in groups:
+            if len(ids) == 0:
+                continue
+
+            if Profiler.active:
+                Profiler.active.tests[TYPE_NAMES[self.object_type[ids[0]]]] += len(origins) * len(ids)
+
+            step = max(1, CHUNK_SIZE // max(1, len(origins)))
+            for start in range(0, len(ids), step):
+                end = start + step
+                solutions = kernel(origins, directions, *[array[start:end] for array in arrays])
+                # argmin returns the first minimum, which is the lowest ID of the chunk
+                nearest = np.argmin(solutions, axis=1)
+                solution = solutions[np.arange(len(origins)), nearest]
+                geometry = ids[start:end][nearest]
+
+                closer = (solution < nearest_solution) | ((solution == nearest_solution) & (geometry < nearest_geometry) & (solution < np.inf))
+                nearest_solution[closer] = solution[closer]
+                nearest_geometry[closer] = geometry[closer]
+
+        if Profiler.active:
+            ids, counts = np.unique(nearest_geometry[nearest_geometry >= 0], return_counts=True)
+            Profiler.active.hits.update(dict(zip(ids.tolist(), counts.tolist())))
+
+        return nearest_solution, nearest_geometry
+
+    def occluded(self, origins, directions, max_distances):
+        # shadow ray query, whether each ray hits any object (lights excluded) before its max distance
+        # which one is closest doesn't matter, so rays that are known to be blocked aren't tested any further
+        occluded = np.zeros(len(origins), dtype=bool)
+
+        groups = [(self.sphere_ids, intersect_spheres, (self.sphere_centers, self.sphere_radii)),
+                  (self.plane_ids, intersect_planes, (self.plane_origins,))]
+
+        if self.bvh is not None:
+            occluded = self.bvh.occluded(origins, directions, max_distances)
+            groups = groups[-1:]
+
+        step = max(1, CHUNK_SIZE // max(1, len(origins)))
+        for ids, kernel, arrays in groups:
+            for start in range(0, len(ids), step):
+                rays = np.flatnonzero(~occluded)
+                if len(rays) == 0:
+                    return occluded
+
+                end = start + step
+                if Profiler.active:
+                    Profiler.active.tests[TYPE_NAMES[self.object_type[ids[0]]]] += len(rays) * len(ids[start:end])
+
+                solutions = kernel(origins[rays], directions[rays], *[array[start:end] for array in arrays])
+                occluded[rays[(solutions < max_distances[rays, None]).any(axis=1)]] = True
+
+        return occluded
+
+    def get_normals(self, intersections, ids):
+        normals = self.normals[ids]
+        curved = self.object_type[ids] != PLANE
+        normals[curved] = normalize_batch(intersections[curved] - self.centers[ids[curved]])
+        return normals
+
+    def get_colors(self, intersections, ids):
+        colors = self.colors[ids]
+        checker = self.checker[ids]
+        if checker.any():
+            colors[checker] = checker_color_batch(intersections[checker], self.centers[ids[checker]])
+
+        return colors
+
+def object_table(objects):
+    # the spheres and planes of a scene as a table of per object arrays, the same thing SceneParser reads from a file
+    # the plane normals are kept as they are, CompiledScene normalizes them
+    count = len(objects)
+    table = {
+        'type': np.empty(count, dtype=np.int8),
+        'centers': np.zeros((count, 3)),
+        'normals': np.zeros((count, 3)),
+        'radii': np.zeros(count),
+        'reflection': np.zeros(count),
+        'colors': np.zeros((count, 3)),
+        'checker': np.zeros(count, dtype=bool),
+    }
+
+    for idx, obj in enumerate(objects):
+        table['centers'][idx] = obj.origin
+        table['reflection'][idx] = obj.material.reflection
+
+        if isinstance(obj, Sphere):
+            table['type'][idx] = SPHERE
+            table['radii'][idx] = obj.radius
+        else:
+            table['type'][idx] = PLANE
+            table['normals'][idx] = obj.normal
+            table['checker'][idx] = obj.checker
+
+        if obj.material.color is not None:
+            table['colors'][idx] = obj.material.color
+
+    return table
+
+def table_objects(table):
+    # the other way around, makes the Sphere and Plane objects of a table
+    objects = []
+    for kind, center, normal, radius, reflection, color, checker in zip(*(table[column].tolist() for column in
+            ('type', 'centers', 'normals', 'radii', 'reflection', 'colors', 'checker'))):
+        color = None if checker else tuple(int(c) for c in color)
+        if kind == SPHERE:
+            objects.append(Sphere(center=tuple(center), radius=radius, material=Material(reflection, color)))
+        else:
+            objects.append(Plane(origin=tuple(center), normal=tuple(normal), material=Material(reflection, color)))
+
+    return objects
+
+def intersect_spheres(origins, directions, centers, radii):
+    # same as solve_quadratic_equation for every ray against every sphere, returns an (N, S) array of distances
+    rOsC = origins[:, None, :] - centers[None, :, :]
+
+    b = 2 * np.einsum('ij,isj->is', directions, rOsC)
+    c = np.einsum('isj,isj->is', rOsC, rOsC) - (radii ** 2)
+    discriminant = (b**2) - (4*c)
+
+    with np.errstate(invalid='ignore'):
+        d2 = (-b - np.sqrt(discriminant)) / (2) # d2 is the smaller solution, so d1 > 0.001 follows from d2 > 0.001
+
+    return np.where((discriminant > 0) & (d2 > 0.001), d2, np.inf)
+
+def intersect_planes(origins, directions, plane_origins):
+    # same as Plane.intersect_test, returns an (N, P) array of distances
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = -((origins[:, 1, None] - plane_origins[None, :, 1]) / directions[:, 1, None])
+
+    return np.where((d > 0.001) & (d < 1e6), d, np.inf)
+
+def checker_color_batch(intersections, plane_origins):
+    # same as Plane.checker_color
+    points = intersections - plane_origins
+
+    # truncate towards zero just like int() does
+    pX = np.trunc(points[:, 0]).astype(np.int64)
+    pZ = np.trunc(points[:, 2]).astype(np.int64)
+
+    even = (pX % 2 == 0) == (pZ % 2 == 0)
+    return np.where(even[:, None], np.array([252, 204, 116]), np.array([30,30,30]))
@@ -0,0 +1,277 @@
+import argparse
+import ipaddress
+import os
+import pickle
+import queue
+import secrets
+import socket
+import subprocess
+import sys
+import threading
+from collections import deque
+from multiprocessing import get_context
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+import numpy as np
+
+from TileRenderer import TILE_SIZE, make_tiles, make_tasks, render_tile, store
+from PathBuffer import PathBuffer
+import Profiler
+
+# Tile rendering across machines. A coordinator (main.py -coordinator host:port) listens for workers
+# (python Distributed.py host:port on every machine) and hands them tiles over TCP, the same tiles the TileRenderer
+# gives its local processes, and the finished tiles are streamed back into the backbuffer as they come in.
+#
+# Every worker gets the scene once, when it connects or when the scene changes, and the camera once per frame,
+# after that a tile is only its region, depth and mask. Workers pull tiles, a worker that's done asks for the next one,
+# so fast machines end up rendering more of the frame. Once every tile is handed out, idle workers get a copy
+# of a tile that another worker is still busy with and whichever is done first wins, so one slow machine can't
+# hold up the end of the frame. Tiles of a worker that disconnects go back into the queue.
+#
+# The messages are pickled, so whoever gets past the authentication of multiprocessing.connection can run code on the other end.
+# There's no built-in authkey: without one the coordinator makes a random key for the workers it starts itself
+# and only listens on a loopback address, see App.py. This is still meant for a trusted network.
+
+PREFETCH = 2 # tiles a worker has at once, so it doesn't sit idle while its result travels back
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+def is_loopback(host):
+    # whether host only reaches this machine, a host that doesn't resolve isn't
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+class Coordinator:
+    # drop-in replacement for TileRenderer (see main.py)
+    def __init__(self, address, width, height, batch=False, tile_size=TILE_SIZE, depth=None, termination=None,
+                 authkey=None, local_workers=0, backbuffer=None):
+        # with a depth the workers also send back the paths of their pixels, which are kept in a PathBuffer of that depth
+        # local_workers starts that many worker processes on this machine
+        # backbuffer is an optional array to render into (see Checkpoint.py), otherwise one is made
+        # without an authkey a random one is made, which only the local workers get
+        authkey = authkey or secrets.token_bytes(32).hex().encode()
+        self.batch = batch
+        self.termination = termination
+        self.tiles = make_tiles(width, height, tile_size)
+        self.backbuffer = backbuffer if backbuffer is not None else np.zeros((width, height, 3))
+        self.paths = PathBuffer(width, height, depth) if depth is not None else None
+
+        self.condition = threading.Condition()
+        self.frame = 0 # bumped for every render and when one is cancelled, results of an older frame are dropped
+        self.pending = deque() # (frame, index) of the tasks nobody has yet
+        self.tasks = {} # (frame, index) -> task of the current frame
+        self.holders = {} # (frame, index) -> amount of workers that have the task
+        self.done = set() # (frame, index) of the tasks whose result came in
+        self.results = queue.Queue()
+        self.scene = None
+        self.scene_message = None # the pickled scene, made once for all workers
+        self.camera_message = None
+        self.connections = []
+        self.closed = False
+
+        self.listener = Listener(address, authkey=authkey)
+        threading.Thread(target=self.accept, daemon=True).start()
+        print("Coordinator listening on %s:%d" % self.listener.address)
+
+        environment = dict(os.environ, RT_AUTHKEY=authkey.decode())
+        self.processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "%s:%d" % self.listener.address], env=environment)
+                          for _ in range(local_workers)]
+
+    def accept(self):
+        while not self.closed:
+            try:
+                connection = self.listener.accept()
+            except AuthenticationError:
+                print("\nA worker failed to authenticate")
+                continue
+            except OSError:
+                return # closed
+
+            with self.condition:
+                self.connections.append(connection)
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def take(self, own):
+        # the next task for a worker that has the tasks own, called with the condition held
+        while self.pending:
+            key = self.pending.popleft()
+            if key[0] == self.frame and key not in self.done:
+                return key
+
+        # steal: a copy of the oldest task that only one other worker has
+        for key in self.tasks:
+            if key not in self.done and key not in own and self.holders[key] == 1:
+                return key
+
+        return None
+
+    def serve(self, connection):
+        # hands tasks to a single worker and passes its results on, until it disconnects
+        own = [] # tasks the worker has, oldest first
+        scene, camera = None, None # the messages the worker has
+        try:
+            while True:
+                sending = []
+                with self.condition:
+                    while not self.closed:
+                        while len(own) + len(sending) < PREFETCH:
+                            key = self.take(own + sending)
+                            if key is None:
+                                break
+                            self.holders[key] += 1
+                            sending.append(key)
+
+                        if own or sending:
+                            break
+                        self.condition.wait()
+
+                    if self.closed:
+                        return
+                    scene_message, camera_message = self.scene_message, self.camera_message
+                    tasks = [self.tasks[key] for key in sending]
+
+                if sending and scene is not scene_message:
+                    connection.send_bytes(scene_message)
+                    scene = scene_message
+                if sending and camera is not camera_message:
+                    connection.send_bytes(camera_message)
+                    camera = camera_message
+                for key, task in zip(sending, tasks):
+                    connection.send(('tile', key) + task)
+                own += sending
+
+                key, result, profiler = connection.recv()
+                own.remove(key)
+                with self.condition:
+                    if key[0] == self.frame and key not in self.done:
+                        self.done.add(key)
+                        self.results.put((key, result, profiler))
+
+        except (EOFError, OSError):
+            pass
+
+        finally:
+            with self.condition:
+                # whatever the worker didn't finish goes back to the front of the queue
+                for key in reversed(own):
+                    if key[0] == self.frame and key not in self.done:
+                        self.holders[key] -= 1
+                        self.pending.appendleft(key)
+                if connection in self.connections:
+                    self.connections.remove(connection)
+                self.condition.notify_all()
+            connection.close()
+
+    def render(self, camera, scene, depth, step=1, dirty=None, samples=1):
+        # generator that yields every tile as soon as its result is in the backbuffer, like TileRenderer.render
+        profiler = Profiler.active
+        record = self.paths is not None and step == 1 and samples == 1
+
+        with self.condition:
+            self.frame += 1
+            frame = self.frame
+            if self.scene_message is None or self.scene is not scene:
+                self.scene = scene
+                self.scene_message = pickle.dumps(('scene', scene, self.batch, self.termination))
+            self.camera_message = pickle.dumps(('camera', camera))
+
+            self.tasks, self.holders, self.done = {}, {}, set()
+            self.pending.clear()
+            index = {tile: index for index, tile in enumerate(self.tiles)}
+            for task in make_tasks(self.tiles, camera, scene, step, dirty,
+                                   lambda tile, mask, candidates: (tile, depth, step, mask, samples, record, profiler is not None, candidates)):
+                key = (frame, index[task[0]])
+                self.tasks[key] = task
+                self.holders[key] = 0
+                self.pending.append(key)
+
+            remaining = len(self.tasks)
+            if not self.connections:
+                print("\nWaiting for workers to connect")
+            self.condition.notify_all()
+
+        try:
+            while remaining:
+                key, result, tile_profiler = self.results.get()
+                if key[0] != frame:
+                    continue
+
+                tile, _, _, mask = self.tasks[key][:4]
+                color = result[0] if record else result
+                store(self.backbuffer, tile, color, mask)
+                if record:
+                    self.paths.write(tile, *result[1:], mask)
+                if profiler:
+                    profiler.merge(tile_profiler)
+
+                remaining -= 1
+                yield tile
+        finally:
+            with self.condition:
+                self.frame += 1
+                self.pending.clear()
+
+    def close(self):
+        # every serve thread closes its connection once it's done with the tile it's on, which lets the worker go
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        self.listener.close()
+        for process in self.processes:
+            process.wait()
+
+def run_worker(address, authkey):
+    connection = Client(address, authkey=authkey)
+    scene = camera = batch = termination = None
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, OSError):
+            return # the coordinator is gone
+
+        if message[0] == 'scene':
+            _, scene, batch, termination = message
+        elif message[0] == 'camera':
+            camera = message[1]
+        else:
+            _, key, tile, depth, step, mask, samples, record, profile, candidates = message
+            if profile:
+                x_start, x_end, y_start, y_end = tile
+                Profiler.start(x_end - x_start, y_end - y_start, x_start, y_start)
+
+            result = render_tile(tile, camera, scene, depth, batch, step, mask, record, termination, samples, candidates)
+            try:
+                connection.send((key, result, Profiler.stop()))
+            except (EOFError, OSError):
+                return
+
+def main():
+    parser = argparse.ArgumentParser(description="Renders tiles for a coordinator (main.py -coordinator)")
+    parser.add_argument('address', type=str, help="host:port of the coordinator")
+    parser.add_argument('-processes', metavar='n', type=int, default=1, help="Worker processes to run on this machine")
+    parser.add_argument('-authkey', type=str, help="Shared secret of the coordinator, defaults to $RT_AUTHKEY")
+    args = parser.parse_args()
+
+    address = parse_address(args.address)
+    authkey = args.authkey or os.environ.get('RT_AUTHKEY')
+    if not authkey:
+        parser.error("the secret of the coordinator has to be given with -authkey or $RT_AUTHKEY")
+    authkey = authkey.encode()
+    if args.processes == 1:
+        run_worker(address, authkey)
+        return
+
+    context = get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(address, authkey)) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+if __name__ == '__main__':
+    main()
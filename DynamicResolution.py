@@ -0,0 +1,59 @@
+import math
+from collections import deque
+from time import perf_counter
+
+# Dynamic resolution for moving the camera around (-frametime).
+# While the camera moves, frames are rendered at the pixel step and reflection depth that fit in the target frame time,
+# and once it stops the frame is rendered again at full quality. Like the progressive passes (see render_passes in main.py),
+# a pixel step of n only traces one pixel out of every n x n block, so the backbuffer keeps its size.
+# The levels go from full quality down to one pixel out of every 8 x 8 block without reflections, taking turns between
+# dropping a reflection and doubling the pixel step. The time of a level is estimated from the last few frames
+# in seconds per unit of work, one traced pixel per bounce of its path, and the best level that fits in the target is picked.
+
+STEPS = [1, 2, 4, 8]
+HISTORY = 5 # frames the estimate is made from
+
+class DynamicQuality:
+    def __init__(self, target, width, height, depth):
+        # target is the frame time in seconds
+        self.target = target
+        self.width = width
+        self.height = height
+        self.levels = quality_levels(depth)
+        self.rates = deque(maxlen=HISTORY) # seconds per unit of work of the last frames
+
+    def work(self, level):
+        step, depth = level
+        return math.ceil(self.width / step) * math.ceil(self.height / step) * (depth + 1)
+
+    def level(self):
+        # (pixel step, reflection depth) of the next frame, the cheapest level until there's a frame to go by
+        if not self.rates:
+            return self.levels[-1]
+
+        rate = sorted(self.rates)[len(self.rates) // 2] # the median, so a single slow frame doesn't change the level
+        for level in self.levels:
+            if self.work(level) * rate <= self.target:
+                return level
+
+        return self.levels[-1]
+
+    def timed(self, frame, level):
+        # passes a frame generator (see render_frame in main.py) rendered at level through and measures it,
+        # a frame that is cancelled before it's done isn't measured
+        start = perf_counter()
+        yield from frame
+        self.rates.append((perf_counter() - start) / self.work(level))
+
+def quality_levels(depth):
+    # (pixel step, reflection depth) from full quality to the cheapest level
+    levels = [(STEPS[0], depth)]
+    step = 0
+    while depth > 0 or step < len(STEPS) - 1:
+        if depth > 0 and (len(levels) % 2 == 1 or step == len(STEPS) - 1):
+            depth -= 1
+        else:
+            step += 1
+        levels.append((STEPS[step], depth))
+
+    return levels
@@ -5,7 +5,7 @@ from utility import *
 class Material:
     def __init__(self, reflection, color):        
         self.reflection = reflection
-        self.color = np.array([color[0], color[1], color[2]]) if color else None
+        self.color = vector3(color) if color else None
         
 class Intersectable:
     
@@ -17,31 +17,37 @@ class Intersectable:
 
     def get_normal(self):
         pass
+
+    def occludes(self, ray, max_distance):
+        # shadow ray query, whether the ray hits this object before max_distance
+        solution = self.intersect_test(ray)
+        return bool(solution) and solution < max_distance
         
 class Sphere(Intersectable):
     def __init__(self, center, radius, material):
-        self.origin = np.array(center) # 3D coordinates of sphere center
-        self.radius = radius
+        self.origin = vector3(center) # 3D coordinates of sphere center
+        self.radius = float(radius)
         self.material = material
 
     def get_normal(self, intersection):
-        return normalize(intersection - self.origin)
+        return normalize3(sub3(intersection, self.origin))
         
     def get_color(self, intersection=None):
         return self.material.color
 
     def intersect_test(self, ray):
-        return solve_quadratic_equation(ray, self)
+        return solve_quadratic3(ray.origin, ray.direction, self.origin, self.radius)
     
 class Plane(Intersectable):
     def __init__(self, origin, normal, material):
-        self.origin = np.array(origin)
-        self.normal = np.array(normal)
+        self.origin = vector3(origin)
+        self.normal = vector3(normal) # as given, CompiledScene normalizes it on its own
+        self.unit_normal = normalize3(self.normal)
         self.material = material
         self.checker = False if self.material.color else True            
 
     def get_normal(self, intersection):
-        return normalize(self.normal)
+        return self.unit_normal
         
     def intersect_test(self, ray):
         rD = ray.direction
@@ -54,6 +60,9 @@ class Plane(Intersectable):
         pOY = pO[1] # plane origin y component
         rDY = rD[1] # ray direction y component
 
+        if rDY == 0: # parallel to the plane
+          return None
+
         d = -((rOY - pOY) / rDY)
 
         #d = -(np.dot(rO, pN) + 1) / np.dot(rD, pN)
@@ -72,30 +81,29 @@ class Plane(Intersectable):
     # checkerboard pattern logic borrowed from here:
     # https://github.com/carl-vbn/pure-java-raytracer/blob/23300fca6e9cb6eb0a830c0cd875bdae56734eb7/src/carlvbn/raytracing/solids/Plane.java#L32
     def checker_color(self, intersection):
-        point = intersection - self.origin
-        
-        pX = int(point[0])
-        pZ = int(point[2])
+        pX = int(intersection[0] - self.origin[0])
+        pZ = int(intersection[2] - self.origin[2])
 
         # for every other x and z position that is even, color the pixel white, otherwise beige
         if ((pX % 2 == 0) == (pZ % 2 == 0)):
-            return np.array([252, 204, 116])
+            return (252.0, 204.0, 116.0)
         else:
-            return np.array([30,30,30])
+            return (30.0, 30.0, 30.0)
 
 class Light(Intersectable):
     def __init__(self, position, intensity, material):
-        self.origin = np.array(position)
+        self.origin = vector3(position)
         self.radius = 0.1
-        self.intensity = intensity
+        self.intensity = float(intensity)
         self.material = material
+        self.last_occluder = None # the object that blocked the last shadow ray towards this light, see compute_color
 
     # treat light points as a sphere
     def intersect_test(self, ray):
-        return solve_quadratic_equation(ray, self)
+        return solve_quadratic3(ray.origin, ray.direction, self.origin, self.radius)
         
     def get_color(self, intersection=None):
         return self.material.color
 
     def get_normal(self, intersection):
-        return normalize(intersection - self.origin)
+        return normalize3(sub3(intersection, self.origin))
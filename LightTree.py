@@ -0,0 +1,129 @@
+import math
+import numpy as np
+
+# Light culling and clustering for scenes with many lights.
+# Without it every hit casts a shadow ray towards every light, even if the light is so far away that it can't change
+# the color at all. The lights are put in a binary tree instead, every cluster (node) of it has the box around
+# its lights, their total intensity and a representative position, the intensity weighted mean of its lights.
+#
+# A light at distance d adds intensity / (4*pi*sqrt(d)) to the lightning of a point, so a cluster adds somewhere between
+# its total intensity / (4*pi*sqrt(far)) and its total intensity / (4*pi*sqrt(near)), where near and far are
+# the distances of the point to the closest and the furthest spot of the box. For every hit the tree is walked from the root:
+# - a cluster that can't add more than its share of the error is culled, no shadow ray at all
+# - a cluster where that range is no wider than its share of the error is shaded as a single light at its
+#   representative position, with a single shadow ray
+# - otherwise its children are looked at, a single light is always shaded as it is
+# The share of a cluster is error * its intensity / the intensity of all lights, weighted by the throughput of the path
+# like in Termination.py, so culling and clustering together change a color channel by at most error per bounce.
+# That bound is on the falloff, the shadow ray of a cluster decides for all of its lights whether they're visible.
+
+class LightCluster:
+    def __init__(self, index, lights, positions, intensities):
+        # index is the one of the cluster in its tree, lights are the indices of the lights in it, positions and intensities are their rows
+        self.index = index
+        self.box_min = positions.min(axis=0)
+        self.box_max = positions.max(axis=0)
+        self.intensity = float(intensities.sum())
+        weights = intensities / self.intensity if self.intensity > 0 else np.full(len(lights), 1 / len(lights))
+        self.origin = tuple(np.clip(weights @ positions, self.box_min, self.box_max).tolist())
+
+        # visibility bit masks of the lights in the cluster, as in Hit.visible_lights and for the batch renderer
+        self.mask = sum(1 << int(light) for light in lights)
+        self.bits = np.uint64(self.mask & ((1 << 64) - 1))
+
+        self.bounds = (tuple(self.box_min.tolist()), tuple(self.box_max.tolist())) # plain floats for the scalar walk
+        self.left = self.right = None
+        self.last_occluder = None # same as Light.last_occluder
+
+class LightTree:
+    def __init__(self, compiled, error):
+        self.error = error
+        positions, intensities = compiled.light_positions, compiled.light_intensities
+        total = float(intensities.sum())
+
+        # a cluster is culled if throughput / sqrt(near) <= budget, and shaded as one if
+        # throughput * (1 / sqrt(near) - 1 / sqrt(far)) <= budget, see the top of the file
+        self.budget = error * 4 * math.pi / (255 * total) if total > 0 else math.inf
+
+        self.clusters = []
+        self.root = self.build(np.arange(len(positions)), positions, intensities) if len(positions) else None
+
+        # the clusters by index, for the batch renderer
+        self.positions = np.array([cluster.origin for cluster in self.clusters]).reshape((-1, 3))
+        self.intensities = np.array([cluster.intensity for cluster in self.clusters])
+        self.bits = np.array([cluster.bits for cluster in self.clusters], dtype=np.uint64)
+
+    def build(self, lights, positions, intensities):
+        cluster = LightCluster(len(self.clusters), lights, positions[lights], intensities[lights])
+        self.clusters.append(cluster)
+        if len(lights) > 1:
+            # median split along the longest side of the box
+            axis = np.argmax(cluster.box_max - cluster.box_min)
+            lights = lights[np.argsort(positions[lights, axis], kind='stable')]
+            half = len(lights) // 2
+            cluster.left = self.build(lights[:half], positions, intensities)
+            cluster.right = self.build(lights[half:], positions, intensities)
+
+        return cluster
+
+    def report(self):
+        return "Light tree: {0} clusters, error {1}".format(len(self.clusters), self.error)
+
+    def select(self, point, throughput):
+        # the clusters to shade a point with (a tuple of floats) on a path with throughput, in the same order as select_batch
+        px, py, pz = point
+        selected = []
+        stack = [self.root] if self.root else []
+        while stack:
+            cluster = stack.pop()
+            (x0, y0, z0), (x1, y1, z1) = cluster.bounds
+
+            # distances to the closest and to the furthest spot of the box
+            nx, ny, nz = max(x0 - px, 0.0, px - x1), max(y0 - py, 0.0, py - y1), max(z0 - pz, 0.0, pz - z1)
+            fx, fy, fz = max(abs(px - x0), abs(px - x1)), max(abs(py - y0), abs(py - y1)), max(abs(pz - z0), abs(pz - z1))
+            near = math.sqrt(nx*nx + ny*ny + nz*nz)
+            far = math.sqrt(fx*fx + fy*fy + fz*fz)
+            inv_near = 1 / math.sqrt(near) if near > 0 else math.inf
+            inv_far = 1 / math.sqrt(far) if far > 0 else math.inf
+
+            if throughput * inv_near <= self.budget:
+                continue
+
+            if cluster.left is None or throughput * (inv_near - inv_far) <= self.budget:
+                selected.append(cluster)
+            else:
+                stack.append(cluster.right)
+                stack.append(cluster.left)
+
+        return selected
+
+    def select_batch(self, points, throughput):
+        # same as select for an (N, 3) array of points, returns the indices of the points and of the clusters to shade them with,
+        # one pair per shadow ray, every point has its clusters in the same order as select gives them
+        selected = []
+        stack = [(self.root, np.arange(len(points)))] if self.root else []
+        while stack:
+            cluster, rays = stack.pop()
+            p = points[rays]
+            near = np.sqrt((np.maximum(np.maximum(cluster.box_min - p, 0.0), p - cluster.box_max) ** 2).sum(axis=1))
+            far = np.sqrt((np.maximum(np.abs(p - cluster.box_min), np.abs(p - cluster.box_max)) ** 2).sum(axis=1))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                inv_near, inv_far = 1 / np.sqrt(near), 1 / np.sqrt(far)
+                t = throughput[rays]
+                culled = t * inv_near <= self.budget
+                single = ~culled & ((cluster.left is None) | (t * (inv_near - inv_far) <= self.budget))
+
+            if single.any():
+                selected.append((rays[single], np.full(np.count_nonzero(single), cluster.index)))
+
+            rest = rays[~culled & ~single]
+            if len(rest):
+                stack.append((cluster.right, rest))
+                stack.append((cluster.left, rest))
+
+        if not selected:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        rays, clusters = (np.concatenate(column) for column in zip(*selected))
+        order = np.argsort(rays, kind='stable')
+        return rays[order], clusters[order]
@@ -0,0 +1,26 @@
+import struct
+import zlib
+import numpy as np
+
+# Minimal PNG writer (8 bit RGB, no filtering), so images can be saved without pygame.
+
+SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+def encode_png(pixels, level=6):
+    # pixels is indexed as [x, y] like the backbuffer, values are rounded and clamped to 0..255 like pygame does
+    rows = np.clip(np.rint(pixels), 0, 255).astype(np.uint8).transpose((1, 0, 2))
+    height, width = rows.shape[:2]
+
+    # every row starts with its filter type, 0 is none
+    raw = np.zeros((height, 1 + width * 3), dtype=np.uint8)
+    raw[:, 1:] = rows.reshape((height, width * 3))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0) # bit depth 8, truecolor, default compression/filter/interlace
+    return SIGNATURE + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw.tobytes(), level)) + chunk(b'IEND', b'')
+
+def write_png(path, pixels, level=6):
+    with open(path, 'wb') as f:
+        f.write(encode_png(pixels, level))
@@ -0,0 +1,204 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+from utility import *
+from CompiledScene import PLANE, CHUNK_SIZE, intersect_spheres, intersect_planes
+from BatchRenderer import BATCH_SIZE, VISIBILITY_BITS, primary_rays, render_coordinates
+
+# Per pixel record of the objects the rays of the last frame ran into, so that reloading a scene
+# only re-traces the pixels that are affected by what changed in the scene file.
+# For every pixel the object ID and distance of the primary hit and of every reflection hit are kept (-1 and inf once a path ends),
+# along with a bit mask of the lights that reach each of those hits.
+# The rest of a path follows from those: the hit points, normals, reflected directions and shadow rays
+# are recomputed from the IDs and distances when a reload needs them, instead of being stored as well.
+# That also makes the buffer a G-buffer, when nothing but the materials and light intensities changed
+# the whole frame is shaded again from it without tracing a single ray (see relight).
+
+class PathBuffer:
+    def __init__(self, width, height, depth, shared=False, names=(None, None, None)):
+        # shared puts the buffers in shared memory for the tile workers, which attach to them by passing the names
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.shm = []
+
+        shape = (width, height, depth + 1)
+        self.ids = self.allocate(shape, np.int32, shared, names[0])
+        self.distances = self.allocate(shape, np.float64, shared, names[1])
+        self.visible = self.allocate(shape, np.uint64, shared, names[2])
+        if names[0] is None:
+            self.ids[:] = -1
+            self.distances[:] = np.inf
+            self.visible[:] = 0
+
+        # only a completely rendered frame can be updated incrementally, the renderer sets this after finishing one
+        self.valid = False
+
+    def allocate(self, shape, dtype, shared, name):
+        if not shared:
+            return np.empty(shape, dtype=dtype)
+
+        if name is None:
+            shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        else:
+            shm = shared_memory.SharedMemory(name=name)
+
+        self.shm.append(shm) # keep a reference, otherwise the buffer is released
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    def names(self):
+        return tuple(shm.name for shm in self.shm)
+
+    def write(self, tile, ids, distances, visible, mask=None):
+        # stores the paths of a tile (or of the pixels of the tile where mask is set) as returned by render_tile
+        # paths that were traced with a lower depth than the buffer was made for are padded
+        x_start, x_end, y_start, y_end = tile
+        for buffer, path, empty in ((self.ids, ids, -1), (self.distances, distances, np.inf), (self.visible, visible, 0)):
+            padded = np.full(path.shape[:-1] + (self.depth + 1,), empty, dtype=buffer.dtype)
+            padded[..., :path.shape[-1]] = path
+
+            if mask is None:
+                buffer[x_start:x_end, y_start:y_end] = padded
+            else:
+                buffer[x_start:x_end, y_start:y_end][mask] = padded
+
+    def can_relight(self, old, new, termination):
+        # whether going from the old to the new compiled scene only changed how things are shaded,
+        # that is every object (lights included) is still in the same place with the same shape
+        # the light tree (see LightTree.py) picks other clusters when the intensities change, so it always traces again
+        # the recorded paths end where termination dropped them (see Termination.py), even at epsilon 0 a path stops at a bounce
+        # with a throughput of 0, so a reflection that stops or starts being 0, or a light that was off, changes where they end
+        # above epsilon 0 any brighter light can, and roulette can't be redone either
+        if not self.valid or len(new.lights) > VISIBILITY_BITS or new.light_tree is not None:
+            return False
+        if termination.epsilon > 0 or termination.roulette > 0:
+            return False
+
+        geometry = ((old.object_type, new.object_type), (old.centers, new.centers), (old.normals, new.normals), (old.radii, new.radii))
+        if not all(np.array_equal(old_array, new_array) for old_array, new_array in geometry):
+            return False
+
+        reflective = np.array_equal(old.reflection > 0, new.reflection > 0)
+        lights_on = not ((old.light_intensities <= 0) & (new.light_intensities > 0)).any()
+        return reflective and lights_on
+
+    def relight(self, tile, camera, scene):
+        # shades the paths of a tile again with the materials and lights of scene, without tracing any rays
+        # only valid if can_relight said so, the result is indexed as [x, y] like the backbuffer
+        x_start, x_end, y_start, y_end = tile
+        xs = camera.viewport.coordinates[1][x_start:x_end]
+        ys = camera.viewport.coordinates[0][y_start:y_end]
+        x, y = np.meshgrid(xs, ys, indexing='ij')
+
+        paths = tuple(buffer[x_start:x_end, y_start:y_end].reshape((-1, self.depth + 1)) for buffer in (self.ids, self.distances, self.visible))
+        color = render_coordinates(x.ravel(), y.ravel(), camera, scene, self.depth, paths=paths, replay=True)
+        return color.reshape((len(xs), len(ys), 3))
+
+    def update(self, old, new, camera):
+        # called with the old and new compiled scene after a reload, returns a (width, height) mask of the pixels
+        # that have to be traced again, or None if the whole frame has to be rendered again
+        # the IDs of the pixels that are left alone are changed to the IDs of the same objects in the new scene
+        # with a light tree the shadow rays went to clusters that crosses doesn't know about, so everything is rendered again
+        if not self.valid or old.light_tree is not None:
+            return None
+
+        removed, added, id_map = diff_scenes(old, new)
+        if id_map is None:
+            return None
+
+        # paths that hit a changed object
+        dirty = np.isin(self.ids, removed).any(axis=2)
+
+        # paths that didn't, but could run into one of the new objects now, or cast a shadow ray that one of the old objects blocked
+        x, y = np.nonzero(~dirty)
+        for start in range(0, len(x), BATCH_SIZE):
+            end = start + BATCH_SIZE
+            dirty[x[start:end], y[start:end]] = self.crosses(x[start:end], y[start:end], old, new, removed, added, camera)
+
+        hit = self.ids >= 0
+        self.ids[hit] = id_map[self.ids[hit]]
+        return dirty
+
+    def crosses(self, x, y, old, new, removed, added, camera):
+        # rebuilds the paths of pixels (x, y) as they were traced in the old scene and checks
+        # every primary, reflection and shadow ray of them against the changed objects
+        ids = self.ids[x, y]
+        distances = self.distances[x, y]
+        origins, directions = primary_rays(camera.viewport.coordinates[1][x], camera.viewport.coordinates[0][y], camera)
+
+        crossed = np.zeros(len(x), dtype=bool)
+        alive = np.arange(len(x)) # pixels whose path has a ray at this bounce
+
+        for bounce in range(self.depth + 1):
+            bounce_ids, bounce_distances = ids[alive, bounce], distances[alive, bounce]
+
+            # something new in front of what the ray hit before
+            crossed[alive] |= blocks(new, added, origins, directions, bounce_distances)
+
+            hit = bounce_ids >= 0
+            alive, origins, directions = alive[hit], origins[hit], directions[hit]
+            bounce_ids, bounce_distances = bounce_ids[hit], bounce_distances[hit]
+            if len(alive) == 0:
+                break
+
+            # same as shade_batch
+            intersections = origins + directions * bounce_distances[:, None]
+            normals = old.get_normals(intersections, bounce_ids)
+            intersections_moved = intersections + (1e-7 * normals)
+
+            # the lights are the same in both scenes, otherwise diff_scenes asks for a full render
+            for position in old.light_positions:
+                l_dir = position - intersections_moved
+                l_length = length_batch(l_dir)
+                l_dir = normalize_batch(l_dir)
+                crossed[alive] |= blocks(old, removed, intersections_moved, l_dir, l_length) | blocks(new, added, intersections_moved, l_dir, l_length)
+
+            origins = intersections_moved
+            directions = normalize_batch(reflect_batch(intersections_moved, normals))
+
+        return crossed
+
+    def close(self):
+        self.ids = None
+        self.distances = None
+        for shm in self.shm:
+            shm.close()
+            shm.unlink()
+
+def diff_scenes(old, new):
+    # matches the objects of two compiled scenes by their signatures, returns the IDs of the old objects that are gone,
+    # the IDs of the new objects that weren't there before, and the new ID of every old object (-1 for the ones that are gone)
+    # the lights light up every pixel, so if they changed at all there's no point in the rest and the map is None
+    old_signatures, new_signatures = old.signatures(), new.signatures()
+    if old_signatures[:len(old.lights)] != new_signatures[:len(new.lights)]:
+        return None, None, None
+
+    unmatched = {}
+    for idx, signature in enumerate(new_signatures):
+        unmatched.setdefault(signature, []).append(idx)
+
+    id_map = np.full(len(old_signatures), -1, dtype=np.int32)
+    for idx, signature in enumerate(old_signatures):
+        if unmatched.get(signature):
+            id_map[idx] = unmatched[signature].pop(0)
+
+    added = sorted(idx for ids in unmatched.values() for idx in ids)
+    return np.flatnonzero(id_map < 0), np.array(added, dtype=np.int64), id_map
+
+def blocks(compiled, ids, origins, directions, max_distances):
+    # whether any of the objects ids of a compiled scene is hit before max_distances, ties count as hits
+    blocked = np.zeros(len(origins), dtype=bool)
+    if len(ids) == 0 or len(origins) == 0:
+        return blocked
+
+    planes = compiled.object_type[ids] == PLANE
+    groups = [(intersect_spheres, ids[~planes], lambda group: (compiled.centers[group], compiled.radii[group])),
+              (intersect_planes, ids[planes], lambda group: (compiled.centers[group],))]
+
+    step = max(1, CHUNK_SIZE // len(origins))
+    for kernel, group, arrays in groups:
+        for start in range(0, len(group), step):
+            solutions = kernel(origins, directions, *arrays(group[start:start + step]))
+            blocked |= ((solutions <= max_distances[:, None]) & (solutions < np.inf)).any(axis=1)
+
+    return blocked
@@ -0,0 +1,142 @@
+import threading
+from time import perf_counter, sleep
+
+import pygame
+from utility import *
+
+# Puts the backbuffer on screen while a RenderThread fills it.
+# Only the regions (rows or tiles) that were rendered since the last refresh are copied into the viewport sized surface,
+# and the surfaces are created once and reused for every refresh instead of being rebuilt from the whole backbuffer.
+
+REFRESH_RATE = 30 # refreshes per second
+
+class Presenter:
+    def __init__(self, framebuffer, font, viewport_width, viewport_height, refresh_rate=REFRESH_RATE):
+        self.framebuffer = framebuffer
+        self.font = font
+        self.budget = 1.0 / refresh_rate
+        self.last_present = 0.0
+
+        self.surface = pygame.Surface((viewport_width, viewport_height), 0, framebuffer)
+        self.scaled = pygame.Surface(framebuffer.get_size(), 0, self.surface) # smoothscale wants the same format on both ends
+
+        self.lock = threading.Lock()
+        self.dirty = [] # regions as (x_start, x_end, y_start, y_end)
+        self.quality = None # (width, height, reflection depth) of the frame, see set_quality
+
+    def mark_dirty(self, region):
+        # called by the render thread whenever it's done with a region of the backbuffer
+        with self.lock:
+            self.dirty.append(region)
+
+    def set_quality(self, step, depth):
+        # the pixel step and reflection depth of the frame that is being rendered, for the overlay
+        self.quality = (-(-self.surface.get_width() // step), -(-self.surface.get_height() // step), depth)
+
+    def reset(self):
+        # everything is stale, e.g. after the backbuffer was replaced
+        self.mark_dirty((0, self.surface.get_width(), 0, self.surface.get_height()))
+
+    def upload(self, backbuffer):
+        with self.lock:
+            regions, self.dirty = self.dirty, []
+
+        if not regions:
+            return False
+
+        pixels = pygame.surfarray.pixels3d(self.surface) # locks the surface until pixels is gone
+        for x_start, x_end, y_start, y_end in regions:
+            # rounded like the screenshots (see PNG.py), assigning floats would truncate them
+            pixels[x_start:x_end, y_start:y_end] = np.clip(np.rint(backbuffer[x_start:x_end, y_start:y_end]), 0, 255)
+        del pixels
+        return True
+
+    def present(self, backbuffer, camera, progress, force=False):
+        # refreshes the window if the time budget of a refresh has passed, returns whether it did
+        now = perf_counter()
+        if not force and now - self.last_present < self.budget:
+            return False
+
+        self.last_present = now
+        self.upload(backbuffer)
+
+        # create an upscaled version of our frame
+        pygame.transform.smoothscale(self.surface, self.framebuffer.get_size(), self.scaled)
+        self.framebuffer.blit(self.scaled, (0, 0))
+
+        text, textrect = print_camera_info(camera, self.font)
+        self.framebuffer.blit(text, textrect)
+
+        if self.quality:
+            text, textrect = quality_text(*self.quality, self.font, self.framebuffer.get_width())
+            self.framebuffer.blit(text, textrect)
+
+        text, textrect = progress_text(progress, self.font)
+        self.framebuffer.blit(text, textrect)
+
+        pygame.display.update()
+        return True
+
+    def wait(self):
+        # sleeps until the next refresh is due
+        remaining = self.budget - (perf_counter() - self.last_present)
+        if remaining > 0:
+            sleep(remaining)
+
+# progress goes from 0 to 1
+def progress_text(progress, font):
+  percentage = progress * 100
+  info = "Progress: " +  "%.2f" % percentage + "%"
+  
+  color = (lerp(0, 255, progress), 0, 255)
+  
+  text = font.render(info, False, color, (0,0,0))
+  textrect = text.get_rect(left=10, top=50)
+  return (text, textrect)
+
+def print_camera_info(camera, font):
+  color = (255, 255, 255)
+  formatter = {'float_kind': lambda x: "%.2f" % x}
+  
+  position = np.array2string(camera.position, precision=4, separator=',', formatter=formatter)
+  look_to = np.array2string(camera.look_to, precision=4, separator=',', formatter=formatter)
+
+  info = "Position: " + position + ", Looking at: " + look_to
+
+  text = font.render(info, False, color, (0,0,0))
+  textpos = text.get_rect(left=0, top=0)
+  return (text, textpos)
+
+def quality_text(width, height, depth, font, right):
+  # the resolution and reflection depth of the frame, in the top right corner next to the camera info
+  info = "Resolution: %dx%d, depth: %d" % (width, height, depth)
+
+  text = font.render(info, False, (255, 255, 255), (0,0,0))
+  textrect = text.get_rect(right=right, top=0)
+  return (text, textrect)
+
+class RenderThread(threading.Thread):
+    # runs a frame generator (see render_frame in main.py) in the background and tells the presenter what changed
+    def __init__(self, frame, presenter):
+        super().__init__(daemon=True)
+        self.frame = frame
+        self.presenter = presenter
+        self.progress = 0.0
+        self.cancelled = threading.Event()
+        self.error = None # what the frame raised, if it did
+
+    def run(self):
+        # the generator is closed on this thread, it can't be closed from another one while it's running
+        try:
+            for self.progress, region in self.frame:
+                self.presenter.mark_dirty(region)
+                if self.cancelled.is_set():
+                    break
+        except BaseException as error:
+            self.error = error
+        finally:
+            self.frame.close()
+
+    def cancel(self):
+        self.cancelled.set()
+        self.join()
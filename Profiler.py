@@ -0,0 +1,100 @@
+import numpy as np
+from collections import Counter
+from time import perf_counter
+
+# Counters for the renderers. Profiler.active is None unless something (the -profile flag, the benchmark) wants numbers,
+# the render code only pays for a single check of that global when nobody is counting.
+
+active = None
+
+class Profiler:
+    def __init__(self, width=0, height=0, x_start=0, y_start=0):
+        self.primary_rays = 0
+        self.shadow_rays = 0
+        self.reflection_rays = 0
+        self.shadow_lookups = 0 # shadows taken from the shadow maps instead of a ray, see ShadowMap.py
+
+        self.tests = Counter() # intersection tests per primitive type
+        self.hits = Counter() # nearest hits per object ID
+        self.depths = Counter() # reflection rays per primary ray -> amount of primary rays
+        self.times = Counter() # seconds spent per phase
+
+        # rays traced per pixel, indexed like the backbuffer
+        # a worker only keeps the region of its tile, which starts at (x_start, y_start)
+        self.cost = np.zeros((width, height))
+        self.x_start = x_start
+        self.y_start = y_start
+
+    def total_rays(self):
+        return self.primary_rays + self.shadow_rays + self.reflection_rays
+
+    def add_time(self, phase, start):
+        self.times[phase] += perf_counter() - start
+
+    def add_cost(self, x_start, y_start, cost):
+        x_start -= self.x_start
+        y_start -= self.y_start
+        self.cost[x_start:x_start + cost.shape[0], y_start:y_start + cost.shape[1]] += cost
+
+    def merge(self, other):
+        # adds the numbers of another profiler, like the one of a worker process
+        self.primary_rays += other.primary_rays
+        self.shadow_rays += other.shadow_rays
+        self.reflection_rays += other.reflection_rays
+        self.shadow_lookups += other.shadow_lookups
+        self.tests.update(other.tests)
+        self.hits.update(other.hits)
+        self.depths.update(other.depths)
+        self.times.update(other.times)
+        self.add_cost(other.x_start, other.y_start, other.cost)
+
+    def summary(self, scene, seconds):
+        from CompiledScene import TYPE_NAMES # CompiledScene imports this module
+        compiled = scene.compile() # the objects of a big scene file might not even exist outside of it
+
+        lines = ["Profile:"]
+        lines.append("  Rays: %d primary, %d shadow, %d reflection, %.0f rays per second" % (
+            self.primary_rays, self.shadow_rays, self.reflection_rays, self.total_rays() / max(seconds, 1e-9)))
+        if self.shadow_lookups:
+            lines.append("  Shadow maps: %d lookups, %.0f%% of the shadows" % (
+                self.shadow_lookups, 100 * self.shadow_lookups / (self.shadow_lookups + self.shadow_rays)))
+        lines.append("  Intersection tests: " + ", ".join("%s %d" % (name, count) for name, count in sorted(self.tests.items())))
+        lines.append("  Reflection depth: " + ", ".join("%d: %d" % (depth, count) for depth, count in sorted(self.depths.items())))
+
+        # the phases are measured inside of each other's time, shading is whatever is left
+        traced = self.times['primary'] + self.times['shadow'] + self.times['reflection']
+        lines.append("  Time: %.3fs total, %.3fs primary rays, %.3fs shadow rays, %.3fs reflection rays, %.3fs shading" % (
+            seconds, self.times['primary'], self.times['shadow'], self.times['reflection'], max(seconds - traced, 0)))
+
+        lines.append("  Most hit objects:")
+        for idx, count in self.hits.most_common(5):
+            lines.append("    #%d %s at %s: %d hits" % (idx, TYPE_NAMES[compiled.object_type[idx]], np.round(compiled.centers[idx], 2).tolist(), count))
+
+        return "\n".join(lines)
+
+    def heatmap(self, tile_size=16):
+        # rays traced per tile as an (width, height, 3) image, black for the cheapest tile and white for the most expensive
+        width, height = self.cost.shape
+        tiles_x, tiles_y = -(-width // tile_size), -(-height // tile_size)
+
+        padded = np.zeros((tiles_x * tile_size, tiles_y * tile_size))
+        padded[:width, :height] = self.cost
+        tiles = padded.reshape((tiles_x, tile_size, tiles_y, tile_size)).sum(axis=(1, 3))
+
+        low, high = tiles.min(), tiles.max()
+        t = (tiles - low) / (high - low) if high > low else np.zeros_like(tiles)
+
+        # black -> red -> yellow -> white
+        color = np.stack([np.clip(t * 3, 0, 1), np.clip(t * 3 - 1, 0, 1), np.clip(t * 3 - 2, 0, 1)], axis=-1) * 255
+        image = np.repeat(np.repeat(color, tile_size, axis=0), tile_size, axis=1)
+        return image[:width, :height].astype(np.uint8)
+
+def start(width=0, height=0, x_start=0, y_start=0):
+    global active
+    active = Profiler(width, height, x_start, y_start)
+    return active
+
+def stop():
+    global active
+    profiler, active = active, None
+    return profiler
@@ -1,42 +1,75 @@
-import numpy as np
+import math
+from time import perf_counter
 from utility import *
 from Intersectable import *
+from Termination import DEFAULT_TERMINATION
+import Profiler
 
 # Neat data structure for hit data
+# Rays, hits and the vectors in them are made for every ray traced, so they're kept small:
+# __slots__ records holding tuples of floats (see the plain float math in utility.py)
 class Hit:
+    __slots__ = ('distance', 'geometry', 'intersection', 'visible_lights', '_normal')
+
     def __init__(self, distance, geometry, intersection):
         self.distance = distance
         self.geometry = geometry
         self.intersection = intersection
-        self.normal = geometry.get_normal(intersection)
+        self.visible_lights = 0 # bit mask of the lights that reach the intersection, filled in by compute_color
+        self._normal = None
+
+    @property
+    def normal(self):
+        # worked out the first time it's asked for
+        if self._normal is None:
+            self._normal = self.geometry.get_normal(self.intersection)
+        return self._normal
     
 class Ray:
+    __slots__ = ('origin', 'direction')
+
     def __init__(self, origin, direction):
         self.origin = origin
         self.direction = direction
 
     def intersection(self, d):
-        return self.origin + self.direction * d
+        o, r = self.origin, self.direction
+        return (o[0] + r[0] * d, o[1] + r[1] * d, o[2] + r[2] * d)
 
-def calculate_pixel(x, y, camera, scene, depth):
+# path is an optional list that receives the hit data (or None) of the primary ray and of every reflection ray
+# candidates is an optional list of the only objects the primary ray can hit, in ID order (see ScreenBins.py)
+def calculate_pixel(x, y, camera, scene, depth, path=None, termination=None, candidates=None):
     # Pygame seems to be using the origin at the upper left corner,
     # so we have to make y negative in order to respect a right-handed coordinate system (3D)
-    pixel = np.array([x,-y,0])
-    direction = normalize(pixel - camera.z) # figure out the direction of the ray
+    z = camera.z.tolist()
+    direction = normalize3((float(x) - z[0], -float(y) - z[1], -z[2])) # figure out the direction of the ray, (x, -y, 0) - camera.z
+
+    color = (0.0, 0.0, 0.0)
+
+    primary_ray = Ray(tuple(camera.position.tolist()), direction)
 
-    color = np.zeros((3))
+    profiler = Profiler.active
+    if profiler:
+      profiler.primary_rays += 1
+      reflection_rays = profiler.reflection_rays
+      start = perf_counter()
 
-    primary_ray = Ray(camera.position, direction)
+    hit_data = trace_scene(primary_ray, scene, candidates=candidates)
 
-    hit_data = trace_ray(primary_ray, scene.get_all_scene_objects())
+    if profiler:
+      profiler.add_time('primary', start)
+
+    if path is not None:
+      path.append(hit_data)
 
     if hit_data:
 
-      color = compute_color(primary_ray, hit_data, scene, depth)
+      red, green, blue = compute_color(primary_ray, hit_data, scene, depth, path, termination)
+      color = (clamp(red, 0, 255), clamp(green, 0, 255), clamp(blue, 0, 255))
 
-      color[0] = clamp(color[0], 0, 255)
-      color[1] = clamp(color[1], 0, 255)
-      color[2] = clamp(color[2], 0, 255)            
+    if profiler:
+      # every reflection ray continues the same path, so the difference is the depth this pixel reached
+      profiler.depths[profiler.reflection_rays - reflection_rays] += 1
 
     return color
     
@@ -44,7 +77,7 @@ def calculate_pixel(x, y, camera, scene, depth):
 def intersect_objects(ray, scene_objects):
 
     solutions = []
-    nearest_solution = np.inf
+    nearest_solution = math.inf
     nearest_geometry = None
     
     # Find the cloests intersection of every intersectable object
@@ -52,6 +85,10 @@ def intersect_objects(ray, scene_objects):
     for obj in scene_objects:
       solutions.append(obj.intersect_test(ray))
 
+    if Profiler.active:
+      for obj in scene_objects:
+        Profiler.active.tests[type(obj).__name__] += 1
+
     # iterate through every intersection and save the closest one and associate it with the relevant 3D object in our scene
     for idx, solution in enumerate(solutions):
       # keep the solution that has the closest distance to ray origin
@@ -64,42 +101,144 @@ def intersect_objects(ray, scene_objects):
     
     return None
 
-def compute_color(ray, hit_data, scene, depth):
-    
-    geometry = hit_data.geometry
+def compute_color(ray, hit_data, scene, depth, path=None, termination=None):
+    # follows the path of a ray bounce by bounce, every bounce adds its color * lightning weighted by the throughput,
+    # which is the product of reflection * lightning of every bounce before it
+    # (the same as evaluating (color + reflected_color * reflection) * lightning for every bounce, innermost first)
+    # termination decides when a path isn't worth following any further, see Termination.py
+    termination = termination or DEFAULT_TERMINATION
+    limit = termination.limit(scene.lights)
+
+    red = green = blue = 0.0
+    throughput = 1.0
+
+    for bounce in range(depth + 1):
+        geometry = hit_data.geometry
+
+        intersection = hit_data.intersection
+        normal = hit_data.normal
+        # nudge it away a little from the intersection point
+        intersection_moved = add3(intersection, scale3(normal, 1e-7)) # NOTE, this is not a normalized vector
+
+        lightning = compute_lightning(hit_data, intersection_moved, scene, throughput)
+        weight = throughput * lightning
+        r, g, b = geometry.get_color(intersection)
+        red += r * weight
+        green += g * weight
+        blue += b * weight
+
+        if bounce == depth:
+            break
+
+        throughput = throughput * geometry.material.reflection * lightning
+        going, throughput = termination.apply(throughput, limit)
+        if not going:
+            break
+
+        ray = Ray(intersection_moved, normalize3(reflect3(intersection_moved, normal)))
 
-    intersection = ray.intersection(hit_data.distance)    
-    # nudge it away a little from the intersection point
-    intersection_moved = intersection + (1e-7 * hit_data.normal) # NOTE, this is not a normalized vector
+        profiler = Profiler.active
+        if profiler:
+          profiler.reflection_rays += 1
+          start = perf_counter()
 
+        hit_data = trace_scene(ray, scene)
+
+        if profiler:
+          profiler.add_time('reflection', start)
+
+        if path is not None:
+          path.append(hit_data)
+
+        if not hit_data:
+            break
+
+    return red, green, blue
+
+def compute_lightning(hit_data, intersection_moved, scene, throughput=1.0):
+    # with a light tree (see LightTree.py) the point is lit by the clusters it picks for a path of this throughput,
+    # a cluster is shaded like a single light
+    # with shadow maps (see ShadowMap.py) only the points they're unsure about trace shadow rays, they're made for the lights and not for clusters
     lightning = 0.0
-    color = geometry.get_color(intersection)
+    tree = scene.compiled.light_tree if scene.compiled else None
+    lights = tree.select(intersection_moved, throughput) if tree else scene.lights
+    maps = scene.compiled.shadow_maps if scene.compiled and not tree else None
 
     # lightning computation from point-based lights
-    for light in scene.lights:
-      l_dir = light.origin - intersection_moved
+    for idx, light in enumerate(lights):
+      l_dir = sub3(light.origin, intersection_moved)
+      l_length = length3(l_dir)
 
       # shadows
-      shadow_ray = Ray(intersection_moved, normalize(l_dir))
-      shadow_data = trace_ray(shadow_ray, scene.objects)
-
-      # check if our shadow ray hit something
-      # check if hit distance is less than the length between the light and the original intersection
-      if shadow_data and shadow_data.distance < length(light.origin - intersection_moved):
-          continue
-      else:
+      lit = maps.lookup_point(idx, intersection_moved, l_length, hit_data.geometry.id) if maps else None
+      if lit is None:
+        shadow_ray = Ray(intersection_moved, (l_dir[0] / l_length, l_dir[1] / l_length, l_dir[2] / l_length))
+
+        profiler = Profiler.active
+        if profiler:
+          profiler.shadow_rays += 1
+          start = perf_counter()
+
+        # check if anything lies between the intersection and the light, the nearest blocker doesn't matter
+        # neighbouring pixels tend to be shadowed by the same object, so whatever blocked this light last time is tried first
+        cached = light.last_occluder
+        if cached and occludes(cached, shadow_ray, l_length):
+          occluder = cached
+        else:
+          occluder = find_occluder(shadow_ray, scene, l_length, skip=cached)
+          if occluder:
+            light.last_occluder = occluder
+
+        if profiler:
+          profiler.add_time('shadow', start)
+
+        lit = occluder is None
+      elif Profiler.active:
+        Profiler.active.shadow_lookups += 1
+
+      if lit:
         # We're modeling a spherical light source
         # thus our attenuation can be based on, for instance, it's distance
-        sqrt_dist = np.sqrt(length(l_dir))
-        lightning += light.intensity / (4*np.pi*sqrt_dist) # Inverse-square law
-        
-    if depth > 0:
-        reflected_ray = Ray(intersection_moved, normalize(reflect(intersection_moved, hit_data.normal)))
-        reflected_data = trace_ray(reflected_ray, scene.get_all_scene_objects())
-        if reflected_data:
-            color = color + compute_color(reflected_ray, reflected_data, scene, depth-1)*geometry.material.reflection
-
-    return color*lightning
+        sqrt_dist = math.sqrt(l_length)
+        lightning += light.intensity / (4*math.pi*sqrt_dist) # Inverse-square law
+        hit_data.visible_lights |= light.mask if tree else 1 << idx
+
+    return lightning
+
+# traces a ray through the whole scene, lights=False leaves the lights out
+# or only through candidates, a list of objects that includes every object the ray can hit
+def trace_scene(ray, scene, lights=True, candidates=None):
+    bvh = scene.compiled.bvh if scene.compiled else None
+    if candidates is not None:
+      hit_data = trace_ray(ray, candidates)
+    elif bvh:
+      hit_data = bvh.trace_ray(ray, lights)
+    else:
+      hit_data = trace_ray(ray, scene.get_all_scene_objects() if lights else scene.objects)
+
+    if Profiler.active and hit_data:
+      Profiler.active.hits[hit_data.geometry.id] += 1
+
+    return hit_data
+
+# any-hit query for shadow rays, returns the first object found that the ray hits before max_distance, or None
+# lights don't cast shadows so only scene.objects are tested, skip is an object that is already known to miss
+def find_occluder(ray, scene, max_distance, skip=None):
+    bvh = scene.compiled.bvh if scene.compiled else None
+    if bvh:
+      return bvh.find_occluder(ray, max_distance, skip)
+
+    for obj in scene.objects:
+      if obj is not skip and occludes(obj, ray, max_distance):
+        return obj
+
+    return None
+
+def occludes(obj, ray, max_distance):
+    if Profiler.active:
+      Profiler.active.tests[type(obj).__name__] += 1
+
+    return obj.occludes(ray, max_distance)
 
 def trace_ray(ray, scene_objects):  
 
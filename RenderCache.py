@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# Finished frames on disk, so rendering the same thing again (a headless -s run, going back to an earlier version
+# of a scene file while it's watched) loads the frame instead of tracing it.
+# A frame is stored under a hash of everything that decides what it looks like: the compiled scene (geometry, materials
+# and lights), the camera, the viewport size, the reflection depth and the render settings (see main.py).
+# The paths of the frame are stored along with it if the renderer keeps them (see PathBuffer.py), so a frame from the cache
+# can still be updated incrementally, supersampled or reprojected like a traced one.
+# Every entry is a file, loading one touches its modification time, and once the directory gets bigger than its size limit
+# the entries that weren't used for the longest time are deleted.
+
+DEFAULT_DIR = ".rendercache"
+DEFAULT_SIZE = 512 # MB
+
+def scene_digest(compiled):
+    # hash of everything in a compiled scene that shows up in the image
+    digest = hashlib.sha256()
+    for array in (compiled.object_type, compiled.centers, compiled.normals, compiled.radii, compiled.reflection,
+                  compiled.colors, compiled.checker, compiled.light_intensities):
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.dtype.str, array.shape)).encode())
+        digest.update(array.tobytes())
+
+    return digest.hexdigest()
+
+class RenderCache:
+    def __init__(self, directory=DEFAULT_DIR, size=DEFAULT_SIZE):
+        # size is the limit of the directory in MB
+        self.directory = directory
+        self.limit = size * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, compiled, camera, depth, settings):
+        # settings is anything JSON can store that changes the image, on top of the scene, the camera and the depth
+        width, height = len(camera.viewport.coordinates[1]), len(camera.viewport.coordinates[0])
+        frame = {"scene": scene_digest(compiled), "position": camera.position.tolist(), "look_to": camera.look_to.tolist(),
+                 "z": camera.z.tolist(), "width": width, "height": height, "depth": depth, "settings": settings}
+        return hashlib.sha256(json.dumps(frame, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key, backbuffer, paths=None):
+        # copies the frame stored under key into backbuffer and its paths into paths if there are any,
+        # returns whether there was such a frame, paths is only left valid if it was filled in
+        try:
+            with np.load(self.path(key), allow_pickle=False) as data:
+                if data['color'].shape != backbuffer.shape:
+                    raise ValueError("the frame has another size")
+                backbuffer[:] = data['color']
+
+                if paths is not None:
+                    paths.valid = 'ids' in data.files and data['ids'].shape == paths.ids.shape
+                    if paths.valid:
+                        paths.ids[:], paths.distances[:], paths.visible[:] = data['ids'], data['distances'], data['visible']
+
+            os.utime(self.path(key)) # most recently used
+
+        except (OSError, KeyError, ValueError):
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        return True
+
+    def store(self, key, backbuffer, paths=None):
+        # a frame that can't be stored (e.g. in a read-only directory) is simply rendered again next time
+        target = self.path(key)
+        temporary = target + ".%d.tmp" % os.getpid()
+        arrays = {"color": np.asarray(backbuffer)}
+        if paths is not None:
+            arrays.update(ids=paths.ids, distances=paths.distances, visible=paths.visible)
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temporary, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(temporary, target) # readers never see a half written frame
+
+        except OSError:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return
+
+        self.evict()
+
+    def evict(self):
+        # deletes the least recently used entries until the directory fits in its limit
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue # deleted in the meantime
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.limit:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return "Render cache: {0} hits, {1} misses ({2:.0f}% hit rate), {3} evicted".format(
+            self.hits, self.misses, 100 * self.hits / lookups if lookups else 0, self.evictions)
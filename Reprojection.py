@@ -0,0 +1,94 @@
+import numpy as np
+
+from BatchRenderer import primary_rays
+
+# Temporal reprojection: when the camera moves, the pixels of the last frame are moved to where their primary hit
+# is seen from the new camera position, which gives a preview of the new frame right away.
+# Without reflections the color of a hit doesn't depend on where it's seen from (there are no highlights),
+# so those pixels are close to what tracing them again gives, they're refined in a second pass that the next move cancels.
+# Pixels that nothing was moved to (disoccluded, or coming in from the side of the screen) and pixels with reflections
+# are traced first. That's any primary hit on a reflective surface, also when the reflection ray left the scene
+# (it sees the sky in another direction) or termination stopped it (it may not from somewhere else).
+# This doesn't save any tracing, the second pass traces every pixel the first one didn't: a reprojected color is only close,
+# and the paths of every pixel have to be traced from the new camera for scene updates, -aa and -cache (see PathBuffer.py).
+# What it changes is the order, the frame is on screen right away and the pixels that are furthest off converge first.
+# The colors are kept along with the hits, the backbuffer can have something else in it by the time the camera moved,
+# like a frame scaled down while moving (see DynamicResolution.py).
+
+class History:
+    def __init__(self, width, height):
+        self.positions = np.full((width, height, 3), np.nan) # world space primary hit of every pixel, nan where unknown
+        self.static = np.zeros((width, height), dtype=bool) # whether the color of a pixel is the same from anywhere
+        self.colors = np.zeros((width, height, 3)) # color of every pixel
+
+    def record(self, region, camera, compiled, paths, backbuffer, mask=None):
+        # called after a region (or the pixels of it where mask is set) of the compiled scene was traced
+        # and its paths and colors were written
+        x_start, x_end, y_start, y_end = region
+        xs = camera.viewport.coordinates[1][x_start:x_end]
+        ys = camera.viewport.coordinates[0][y_start:y_end]
+        x, y = np.meshgrid(xs, ys, indexing='ij')
+        if mask is None:
+            mask = np.ones(x.shape, dtype=bool)
+
+        origins, directions = primary_rays(x[mask], y[mask], camera)
+        distances = paths.distances[x_start:x_end, y_start:y_end, 0][mask]
+        ids = paths.ids[x_start:x_end, y_start:y_end, 0][mask]
+        hit = np.isfinite(distances) & (ids >= 0)
+
+        positions = np.full(origins.shape, np.nan)
+        positions[hit] = origins[hit] + directions[hit] * distances[hit, None]
+        self.positions[x_start:x_end, y_start:y_end][mask] = positions
+        static = hit.copy()
+        static[hit] = compiled.reflection[ids[hit]] <= 0
+        self.static[x_start:x_end, y_start:y_end][mask] = static
+        self.colors[x_start:x_end, y_start:y_end][mask] = backbuffer[x_start:x_end, y_start:y_end][mask]
+
+    def clear(self):
+        # forgets every pixel, for a backbuffer that was filled in some other way than tracing it or a scene that was reloaded
+        self.positions[:] = np.nan
+        self.static[:] = False
+
+    def reproject(self, backbuffer, camera):
+        # moves the recorded pixels to where camera sees them now and puts them into the backbuffer,
+        # the nearest one wins if several land on a pixel
+        # returns a (width, height) mask of the pixels that have to be traced first
+        width, height = self.static.shape
+        known = np.isfinite(self.positions).all(axis=2)
+        positions, colors, static = self.positions[known], self.colors[known], self.static[known]
+
+        # a pixel at viewport coordinates (x, y) looks along (x, -y, 0) - camera.z (see primary_rays),
+        # so a point is seen at the pixel where that line crosses z = 0
+        relative = positions - camera.position
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = -camera.z[2] / relative[:, 2]
+            x = camera.z[0] + scale * relative[:, 0]
+            y = -(camera.z[1] + scale * relative[:, 1])
+
+            xs, ys = camera.viewport.coordinates[1], camera.viewport.coordinates[0]
+            column = np.rint((x - xs[0]) / (xs[1] - xs[0]))
+            row = np.rint((y - ys[0]) / (ys[1] - ys[0]))
+
+        visible = (scale > 0) & (column >= 0) & (column < width) & (row >= 0) & (row < height)
+        target = column[visible].astype(np.int64) * height + row[visible].astype(np.int64)
+        distance = np.linalg.norm(relative[visible], axis=1)
+
+        # z-buffer, sort by pixel and then by distance and keep the first of every pixel
+        order = np.lexsort((distance, target))
+        target, first = np.unique(target[order], return_index=True)
+        source = np.flatnonzero(visible)[order[first]]
+
+        filled = np.zeros(width * height, dtype=bool)
+        filled[target] = True
+        filled = filled.reshape((width, height))
+
+        self.positions[:] = np.nan
+        self.static[:] = False
+        self.colors[:] = 0
+        backbuffer[:] = 0
+
+        self.positions.reshape((-1, 3))[target] = positions[source]
+        self.static.reshape(-1)[target] = static[source]
+        self.colors.reshape((-1, 3))[target] = colors[source]
+        backbuffer.reshape((-1, 3))[target] = colors[source]
+        return ~filled | ~self.static
@@ -0,0 +1,91 @@
+from utility import *
+from Intersectable import *
+from CompiledScene import CompiledScene, object_table, table_objects
+from BVH import BVH
+from LightTree import LightTree
+from ShadowMap import ShadowMaps
+
+class Scene:
+    def __init__(self, default):
+        self._objects = []
+        self.table = None # the objects as arrays when they were loaded from a file, see set_table
+        self.lights = []
+        self.all_objects = None # cached lights + objects
+        self.compiled = None
+        
+        # default init
+        if default:
+            print("Loading default scene")
+            self.add_object(Sphere(center=(-9.0, 3.2, -12.0), radius=4.0, material=Material(1.0, (255, 0,0))))
+            self.add_object(Sphere(center=(-0.5, 2.0, -8.0), radius=3.0, material=Material(1.0, (0, 255, 0))))
+            self.add_object(Sphere(center=(4.0, 1.0, -6.0), radius=2.0, material=Material(1.0, (0, 0, 255))))
+            self.add_object(Sphere(center=(5.0, 0.0, -3.0), radius=1.0, material=Material(1.0, (255, 255, 0))))
+            
+            self.add_object(Plane(origin=(0.0, -1.0 , 0.0), normal=(0, 1, 0), material=Material(1.0, None)))
+    
+            self.add_light(Light(position=(6.0, 4.0, -3.0), intensity=10.0, material=Material(0.0, (255,255,255))))
+            self.add_light(Light(position=(0.0, 4.0, 0.0), intensity=7.0, material=Material(0.0, (255,255,255))))
+        
+    @property
+    def objects(self):
+        # a scene loaded from a file only makes its objects once something asks for them
+        if self._objects is None:
+            self._objects = table_objects(self.table)
+            self.number_objects(len(self.lights))
+        return self._objects
+
+    def set_table(self, table):
+        # replaces the objects with a table of per object arrays (see object_table in CompiledScene.py)
+        self._objects = None
+        self.table = table
+        self.changed()
+
+    def object_table(self):
+        if self.table is None:
+            self.table = object_table(self.objects)
+        return self.table
+
+    def number_objects(self, first_id):
+        # objects get their ID from CompiledScene, or from here for the ones that are made after it
+        if self._objects is not None:
+            for idx, obj in enumerate(self._objects, first_id):
+                obj.id = idx
+
+    def add_object(self, obj):
+        self.objects.append(obj)
+        self.table = None
+        self.changed()
+
+    def add_light(self, light):
+        self.lights.append(light)
+        self.changed()
+
+    def changed(self):
+        # drop everything derived from the object lists
+        self.all_objects = None
+        self.compiled = None
+
+    def get_all_scene_objects(self):
+        # called for every primary and reflection ray, so only build the list once
+        if self.all_objects is None:
+            self.all_objects = self.lights + self.objects
+        return self.all_objects
+
+    def compile(self, bvh=None, light_error=None, shadow_resolution=None):
+        # flatten the scene into typed arrays for the batched renderers, see CompiledScene.py
+        # bvh is the split heuristic of the BVH to build, if any
+        # light_error is the error bound of the light tree to build, if any
+        # shadow_resolution is the one of the shadow maps to build, if any, they're made after the BVH which speeds them up
+        if self.compiled is None:
+            self.compiled = CompiledScene(self)
+
+        if bvh and (self.compiled.bvh is None or self.compiled.bvh.heuristic != bvh):
+            self.compiled.bvh = BVH(self.compiled, bvh)
+
+        if light_error and (self.compiled.light_tree is None or self.compiled.light_tree.error != light_error):
+            self.compiled.light_tree = LightTree(self.compiled, light_error)
+
+        if shadow_resolution and (self.compiled.shadow_maps is None or self.compiled.shadow_maps.resolution != shadow_resolution):
+            self.compiled.shadow_maps = ShadowMaps(self.compiled, shadow_resolution)
+
+        return self.compiled
@@ -1,60 +1,146 @@
-import App
+from Scene import Scene
 from Intersectable import *
+from CompiledScene import SPHERE, PLANE
 from utility import clamp
+import numpy as np
+import hashlib
+import os
 import re
 
-def load_scene_file(path):
-    scene = App.Scene(False)
-    data = []
+# Scene files are parsed line by line straight into the per object arrays of CompiledScene (see object_table),
+# the Sphere and Plane objects themselves are only made if something asks for scene.objects.
+# The arrays are cached next to the scene file in CACHE_DIR, keyed by the path, size and a hash of the contents of the file,
+# so loading the same file again (or reloading it after saving it without changing it) skips the parsing.
+# Hashing reads the file once more, which is still much faster than parsing it.
+
+NUMBER = re.compile(r'(-?\d+\.\d|\d+)')
+CACHE_DIR = ".scenecache"
+
+# object table columns, and the light columns which are stored in the cache under a "light_" prefix
+OBJECT_COLUMNS = ('type', 'centers', 'normals', 'radii', 'reflection', 'colors', 'checker')
+LIGHT_COLUMNS = ('positions', 'intensities', 'reflection', 'colors')
+
+def load_scene_file(path, cache=True):
     try:
-        with open(path) as f:
-            data = f.readlines()
-            f.seek(0)
-            
-        for line in data:
-            m = re.findall(r'(-?\d+\.\d|\d+)', line)
-            if m:
-                if "Sphere:" in line:
-                    print("Sphere:", m)
-                    if expected_match_size(m, 8):
-                        scene.add_object(Sphere(
-                            center=(float(m[0]), float(m[1]), float(m[2])),
-                            radius=float(m[3]),
-                            material=Material(
-                                float(m[4]),
-                                (clamp(int(m[5]), 0, 255), clamp(int(m[6]), 0, 255), clamp(int(m[7]), 0, 255)))))
-
-                elif "Plane:" in line:
-                    print("Plane:", m)
-                    if expected_match_size(m, 8):                                             
-                        scene.add_object(Plane(
-                            origin=(float(m[0]), float(m[1]), float(m[2])),
-                            normal=(float(m[3]), float(m[4]), float(m[5])),
-                            material=Material(
-                            float(m[6]), None)))
-
-                elif "Light:" in line:
-                    print("Light:", m)
-                    if expected_match_size(m, 8):                                         
-                        scene.add_light(Light(
-                            position=(float(m[0]), float(m[1]), float(m[2])),
-                            intensity=float(m[3]),
-                            material=Material(
-                            float(m[4]), (clamp(int(m[5]), 0, 255), clamp(int(m[6]), 0, 255), clamp(int(m[7]), 0, 255)))))
-        
-    except Error:
+        key = cache_key(path)
+        cached = read_cache(path, key) if cache else None
+        if cached:
+            table, lights = cached
+        else:
+            table, lights = parse_scene_file(path)
+            if cache:
+                write_cache(path, key, table, lights)
+
+    except OSError:
         print("Error loading scene file!")
-        return App.Scene(default=True) # default init
-    
+        return Scene(default=True) # default init
+
+    scene = Scene(False)
+    for position, intensity, reflection, color in zip(*(lights[column].tolist() for column in LIGHT_COLUMNS)):
+        scene.add_light(Light(position=tuple(position), intensity=intensity,
+                              material=Material(reflection, tuple(int(c) for c in color))))
+    scene.set_table(table)
 
-    print("Loaded scene file!")
+    print("Loaded scene file!", "%d spheres, %d planes, %d lights%s" % (
+        np.count_nonzero(table['type'] == SPHERE), np.count_nonzero(table['type'] == PLANE), len(scene.lights),
+        " (cached)" if cached else ""))
     return scene
 
+def parse_scene_file(path):
+    # returns the object table and the light columns of a scene file
+    kinds = []
+    objects = [] # the 8 numbers of every sphere and plane line
+    lights = []
+
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            m = NUMBER.findall(line)
+            if not m:
+                continue
+
+            if "Sphere:" in line:
+                if expected_match_size(m, 8, number):
+                    kinds.append(SPHERE)
+                    objects.append([float(value) for value in m[:5]] + [clamp(int(value), 0, 255) for value in m[5:]])
+
+            elif "Plane:" in line:
+                if expected_match_size(m, 8, number):
+                    kinds.append(PLANE)
+                    objects.append([float(value) for value in m[:7]] + [0])
+
+            elif "Light:" in line:
+                if expected_match_size(m, 8, number):
+                    lights.append([float(value) for value in m[:5]] + [clamp(int(value), 0, 255) for value in m[5:]])
+
+    kinds = np.array(kinds, dtype=np.int8)
+    objects = np.array(objects, dtype=float).reshape((-1, 8))
+    lights = np.array(lights, dtype=float).reshape((-1, 8))
+    spheres, planes = kinds == SPHERE, kinds == PLANE
+
+    # sphere: center, radius, reflection, color, plane: origin, normal, reflection, light: position, intensity, reflection, color
+    table = {
+        'type': kinds,
+        'centers': objects[:, 0:3].copy(),
+        'normals': np.where(planes[:, None], objects[:, 3:6], 0.0),
+        'radii': np.where(spheres, objects[:, 3], 0.0),
+        'reflection': np.where(spheres, objects[:, 4], objects[:, 6]),
+        'colors': np.where(spheres[:, None], objects[:, 5:8], 0.0),
+        'checker': planes, # the planes of a scene file have no color of their own
+    }
+    light_columns = {
+        'positions': lights[:, 0:3].copy(),
+        'intensities': lights[:, 3].copy(),
+        'reflection': lights[:, 4].copy(),
+        'colors': lights[:, 5:8].copy(),
+    }
+    return table, light_columns
 
-def expected_match_size(m, expected_size):
+def cache_path(path):
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, CACHE_DIR, name + ".npz")
+
+def cache_key(path):
+    # raises OSError if the scene file can't be read
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+            size += len(chunk)
+
+    return "%s|%d|%s" % (os.path.abspath(path), size, digest.hexdigest())
+
+def read_cache(path, key):
+    # returns the table and the light columns of path if the cache has them for this version of the file, None otherwise
+    try:
+        with np.load(cache_path(path), allow_pickle=False) as data:
+            if str(data['key']) != key:
+                return None
+
+            table = {column: data[column] for column in OBJECT_COLUMNS}
+            lights = {column: data['light_' + column] for column in LIGHT_COLUMNS}
+            return table, lights
+
+    except (OSError, KeyError, ValueError):
+        return None
+
+def write_cache(path, key, table, lights):
+    # a scene that can't be cached (e.g. in a read-only directory) is simply parsed again next time
+    target = cache_path(path)
+    temporary = target + ".%d.tmp" % os.getpid()
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(temporary, 'wb') as f:
+            np.savez(f, key=np.array(key), **table, **{'light_' + column: array for column, array in lights.items()})
+        os.replace(temporary, target) # readers never see a half written cache
+
+    except OSError:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+def expected_match_size(m, expected_size, line_number):
     if len(m) == expected_size:
         return True
 
-    print("Size of search result was not as expected!")
+    print("Line %d: size of search result was not as expected!" % line_number)
     return False
-
@@ -0,0 +1,67 @@
+import numpy as np
+
+# Screen-space binning for primary rays. Once per frame every sphere and light is projected onto the viewport,
+# which gives the block of pixels whose primary rays can hit it. The primary rays of a tile then only test the objects
+# whose block overlaps the tile, planes are unbounded and always tested. How many objects a tile has to test
+# is also a cheap estimate of how long it takes, the tile renderers start with the expensive ones.
+# With a BVH the bins aren't used, a tile of a big scene can see thousands of spheres and testing all of them is slower than the BVH.
+#
+# A pixel at viewport coordinates (x, y) looks along (x, -y, 0) - camera.z (see primary_rays), so a point that is
+# relative to the camera position at r is seen at x = z[0] - z[2] * r[0] / r[2], y = z[2] * r[1] / r[2] - z[1].
+# Over a sphere the ratio r[0] / r[2] only depends on its disc in the xz plane, so its range is the slope of the
+# two tangents from the camera to that disc, the same goes for r[1] / r[2].
+
+class ScreenBins:
+    def __init__(self, camera, compiled):
+        self.plane_ids = compiled.plane_ids
+        self.ids = np.concatenate([compiled.light_ids, compiled.sphere_ids])
+        centers = np.concatenate([compiled.light_positions, compiled.sphere_centers]).reshape((-1, 3))
+        radii = np.concatenate([compiled.light_radii, compiled.sphere_radii])
+
+        xs, ys = camera.viewport.coordinates[1], camera.viewport.coordinates[0]
+        width, height = len(xs), len(ys)
+        z = camera.z
+        relative = centers - camera.position
+
+        # [x_start, x_end) and [y_start, y_end) of the pixels that can see each object, everything to start with
+        self.bounds = np.tile(np.array([0, width, 0, height]), (len(self.ids), 1))
+        if z[2] == 0 or width < 2 or height < 2:
+            return
+
+        # spheres with a side that's right next to the camera or behind it stay everywhere,
+        # the ones that are completely behind it can't be seen at all
+        depth = relative[:, 2] * -np.sign(z[2])
+        ahead = depth > radii
+        behind = -depth > radii
+        self.bounds[behind] = 0
+
+        x_low, x_high = tangent_slopes(relative[ahead, 0], relative[ahead, 2], radii[ahead])
+        y_low, y_high = tangent_slopes(relative[ahead, 1], relative[ahead, 2], radii[ahead])
+        x = z[0] - z[2] * np.stack([x_low, x_high])
+        y = z[2] * np.stack([y_low, y_high]) - z[1]
+
+        # one pixel more on every side covers rounding and the subpixel samples of -aa
+        dx, dy = xs[1] - xs[0], ys[1] - ys[0]
+        x_start = np.floor((x.min(axis=0) - xs[0]) / dx) - 1
+        x_end = np.ceil((x.max(axis=0) - xs[0]) / dx) + 2
+        y_start = np.floor((y.min(axis=0) - ys[0]) / dy) - 1
+        y_end = np.ceil((y.max(axis=0) - ys[0]) / dy) + 2
+
+        bounds = np.stack([np.clip(x_start, 0, width), np.clip(x_end, 0, width), np.clip(y_start, 0, height), np.clip(y_end, 0, height)], axis=1)
+        self.bounds[ahead] = bounds.astype(np.int64)
+
+    def candidates(self, region):
+        # the IDs of the objects the primary rays of a region (x_start, x_end, y_start, y_end) can hit, in ID order
+        x_start, x_end, y_start, y_end = region
+        b = self.bounds
+        overlap = (b[:, 0] < x_end) & (b[:, 1] > x_start) & (b[:, 2] < y_end) & (b[:, 3] > y_start)
+        return np.sort(np.concatenate([self.ids[overlap], self.plane_ids]))
+
+def tangent_slopes(a, c, radius):
+    # the smallest and largest a / c over discs centered at (a, c) with radius, none of which reach c = 0
+    # the tangents a = k * c from the origin solve k^2 (c^2 - r^2) - 2 k a c + a^2 - r^2 = 0
+    denominator = c*c - radius*radius
+    root = radius * np.sqrt(np.maximum(a*a + c*c - radius*radius, 0))
+    k1 = (a*c - root) / denominator
+    k2 = (a*c + root) / denominator
+    return np.minimum(k1, k2), np.maximum(k1, k2)
@@ -0,0 +1,181 @@
+import numpy as np
+from CompiledScene import SPHERE
+
+# Precomputed shadows for the lights, made once per compiled scene, so once per scene load (lights don't move in between).
+# For every light a cube map stores the distance from the light to the first object in every direction,
+# resolution x resolution texels on each of the 6 faces. A point at distance d from a light is in its shadow
+# if the map has something closer than d in its direction.
+# A point is never shadowed by the object it's on (see compute_lightning, a shadow ray can't hit it), so the maps have two layers:
+# the first object in a direction and its distance, and the distance to the first other object.
+# A point on the first object looks at the second layer, which also means a surface can't shadow itself (no shadow acne).
+# A texel only knows the distances along the ray through its center, so a lookup looks at the 3 x 3 texels around the point:
+# - lit if none of them have anything closer than d - bias
+# - shadowed if all of them do
+# - otherwise the point is at the edge of a shadow and the shadow ray is traced as usual
+# The bias grows with d / resolution, it's how far the distance to a surface can change over a few texels.
+# Occluders that are closer than the bias to a point, or too thin to cover a single texel center, can be missed.
+# The texels at the border of a face don't have all of their neighbours on it, points that fall on them always trace the shadow ray.
+# Planes are horizontal for the intersection code (see intersect_planes), so only a plane's height counts when it's close to a sphere.
+
+BIAS = 1e-3
+BIAS_SLOPE = 4 # in texels
+MIXED = -1 # the first object of a neighbourhood of texels that don't all see the same one first
+
+class ShadowMaps:
+    def __init__(self, compiled, resolution):
+        self.resolution = resolution
+        self.positions = compiled.light_positions
+        self.origins = [tuple(position) for position in self.positions.tolist()] # plain floats for lookup_point
+        self.slope = BIAS_SLOPE / resolution
+
+        # directions through the texel centers of every face, face 2 * axis + (negative side)
+        # the texel (i, j) of a face is at u = i and v = j along the next two axes, (axis + 1) % 3 and (axis + 2) % 3
+        centers = (np.arange(resolution) + 0.5) * 2 / resolution - 1
+        u, v = np.meshgrid(centers, centers, indexing='ij')
+        directions = np.zeros((6, resolution, resolution, 3))
+        for face in range(6):
+            axis = face // 2
+            directions[face, :, :, axis] = -1 if face % 2 else 1
+            directions[face, :, :, (axis + 1) % 3] = u
+            directions[face, :, :, (axis + 2) % 3] = v
+        directions = (directions / np.linalg.norm(directions, axis=3, keepdims=True)).reshape((-1, 3))
+        objects = np.concatenate([compiled.sphere_ids, compiled.plane_ids])
+        touching = touching_spheres(compiled)
+
+        # a light in a sphere isn't in the maps, the sphere can't be seen from the inside but it blocks the shadow rays from outside of it
+        # the shadows of such a light are always traced
+        inside = np.linalg.norm(self.positions[:, None, :] - compiled.sphere_centers[None, :, :], axis=2) < compiled.sphere_radii + 0.001
+        self.enclosed = inside.any(axis=1).tolist()
+
+        # per layer the smallest and largest distance over the 3 x 3 texels around every texel, and the object all of them see first
+        # float32 keeps the maps small
+        shape = (len(self.positions), 6, resolution, resolution)
+        self.closest = np.empty((2,) + shape, dtype=np.float32)
+        self.furthest = np.empty((2,) + shape, dtype=np.float32)
+        self.first = np.empty(shape, dtype=np.int32)
+        for light, position in enumerate(self.positions):
+            if self.enclosed[light]:
+                continue
+
+            origins = np.tile(position, (len(directions), 1))
+            first, ids = compiled.intersect(origins, directions, lights=False)
+            second = np.full(len(directions), np.inf)
+
+            # the second layer is traced from where a ray leaves the object it hit first, the far side of a sphere
+            exits = first.copy()
+            spheres = np.flatnonzero((ids >= 0) & (compiled.object_type[ids] == SPHERE))
+            offset = origins[spheres] - compiled.centers[ids[spheres]]
+            b = np.einsum('ij,ij->i', directions[spheres], offset)
+            c = np.einsum('ij,ij->i', offset, offset) - compiled.radii[ids[spheres]] ** 2
+            exits[spheres] = -b + np.sqrt(np.maximum(b*b - c, 0))
+
+            rays = np.flatnonzero((ids >= 0) & ~touching[ids])
+            distances, _ = compiled.intersect(origins[rays] + directions[rays] * exits[rays, None], directions[rays], lights=False)
+            second[rays] = exits[rays] + distances
+
+            # a sphere that touches other objects can have them on both sides of where the ray leaves it,
+            # so the rays that hit one of those first are traced again without it
+            rays = np.flatnonzero((ids >= 0) & touching[ids])
+            order = rays[np.argsort(ids[rays], kind='stable')]
+            hit_ids, starts = np.unique(ids[order], return_index=True)
+            for obj, group in zip(hit_ids, np.split(order, starts[1:])):
+                second[group], _ = compiled.intersect(origins[group], directions[group], lights=False, candidates=objects[objects != obj])
+
+            for layer, distances in enumerate((first, second)):
+                distances = distances.reshape((6, resolution, resolution))
+                self.closest[layer, light] = neighbourhood(distances, np.minimum, -np.inf)
+                self.furthest[layer, light] = neighbourhood(distances, np.maximum, np.inf)
+
+            ids = ids.reshape((6, resolution, resolution))
+            lowest = neighbourhood(ids, np.minimum, MIXED - 1)
+            self.first[light] = np.where(lowest == neighbourhood(ids, np.maximum, MIXED), lowest, MIXED)
+
+    def report(self):
+        size = self.closest.nbytes + self.furthest.nbytes + self.first.nbytes
+        return "Shadow maps: {0} lights, {1} x {1} texels per face, {2:.1f} MB".format(len(self.positions), self.resolution, size / (1024 * 1024))
+
+    def texels(self, light, points):
+        # the face and texel of every point (an (N, 3) array) in the map of a light
+        d = points - self.positions[light]
+        rows = np.arange(len(d))
+        axis = np.argmax(np.abs(d), axis=1)
+        major = d[rows, axis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = d[rows, (axis + 1) % 3] / np.abs(major)
+            v = d[rows, (axis + 2) % 3] / np.abs(major)
+            i = np.clip(np.nan_to_num((u + 1) * 0.5 * self.resolution), 0, self.resolution - 1).astype(np.int64)
+            j = np.clip(np.nan_to_num((v + 1) * 0.5 * self.resolution), 0, self.resolution - 1).astype(np.int64)
+
+        return 2 * axis + (major < 0), i, j
+
+    def lookup(self, light, points, distances, ids):
+        # for points at distances from a light on the objects with ids, returns whether each of them is lit for sure
+        # and whether it's shadowed for sure, the ones that are neither need a shadow ray
+        if self.enclosed[light]:
+            return np.zeros(len(points), dtype=bool), np.zeros(len(points), dtype=bool)
+
+        face, i, j = self.texels(light, points)
+        first = self.first[light, face, i, j]
+        limit = distances - (distances * self.slope + BIAS)
+
+        # only points on the object all the texels see first can skip it, with a mix of objects it might be any of the two layers
+        own = (first == ids).astype(np.int64)
+        lit = self.closest[own, light, face, i, j] >= limit
+        shadowed = self.furthest[own | (first == MIXED), light, face, i, j] < limit
+        return lit, shadowed
+
+    def lookup_point(self, light, point, distance, obj_id):
+        # same as lookup for a single point (a tuple of floats) on the object with obj_id,
+        # returns True if it's lit, False if it's shadowed and None if it's unsure
+        if self.enclosed[light]:
+            return None
+
+        lx, ly, lz = self.origins[light]
+        dx, dy, dz = point[0] - lx, point[1] - ly, point[2] - lz
+        ax, ay, az = abs(dx), abs(dy), abs(dz)
+        # ties go to the first axis like np.argmax
+        if ax >= ay and ax >= az:
+            face, major, u, v = 0 if dx >= 0 else 1, ax, dy, dz
+        elif ay >= az:
+            face, major, u, v = 2 if dy >= 0 else 3, ay, dz, dx
+        else:
+            face, major, u, v = 4 if dz >= 0 else 5, az, dx, dy
+
+        if major == 0:
+            return None
+
+        last = self.resolution - 1
+        i = min(max(int((u / major + 1) * 0.5 * self.resolution), 0), last)
+        j = min(max(int((v / major + 1) * 0.5 * self.resolution), 0), last)
+
+        first = self.first[light, face, i, j]
+        limit = distance - (distance * self.slope + BIAS)
+        if self.closest[int(first == obj_id), light, face, i, j] >= limit:
+            return True
+        if self.furthest[int(first == obj_id or first == MIXED), light, face, i, j] < limit:
+            return False
+        return None
+
+def touching_spheres(compiled):
+    # whether each object is a sphere that overlaps or touches another sphere or a plane, by object ID
+    centers, radii = compiled.sphere_centers, compiled.sphere_radii
+    touching = np.zeros(len(compiled.object_type), dtype=bool)
+    for start in range(0, len(radii), 1024):
+        end = start + 1024
+        gaps = np.linalg.norm(centers[start:end, None, :] - centers[None, :, :], axis=2) - radii[start:end, None] - radii[None, :]
+        gaps[np.arange(len(gaps)), np.arange(start, start + len(gaps))] = np.inf
+        planes = np.abs(centers[start:end, None, 1] - compiled.plane_origins[None, :, 1]) - radii[start:end, None]
+        touching[compiled.sphere_ids[start:end]] = (gaps < 0.001).any(axis=1) | (planes < 0.001).any(axis=1)
+
+    return touching
+
+def neighbourhood(values, reduce, border):
+    # reduces the 3 x 3 texels around every texel of every face, the texels at the border of a face get border
+    resolution = values.shape[1]
+    padded = np.pad(values, ((0, 0), (1, 1), (1, 1)), constant_values=border)
+    result = padded[:, 1:-1, 1:-1].copy()
+    for di in range(3):
+        for dj in range(3):
+            result = reduce(result, padded[:, di:di + resolution, dj:dj + resolution])
+
+    return result
@@ -0,0 +1,47 @@
+import numpy as np
+
+# Adaptive anti-aliasing: after a frame is done, the pixels on an edge are traced again with samples x samples rays
+# spread over their area, and get the average of those as their color. Everything else keeps its single ray.
+# A pixel is on an edge when one of its 4 neighbours hit another object with its primary ray, sees other lights
+# from its primary hit (a shadow edge), or differs by more than a threshold in any color channel (the checker plane, reflections).
+# The IDs and the visible lights of the primary hits come from the PathBuffer of the frame.
+
+DEFAULT_THRESHOLD = 24 # out of 255
+
+def find_edges(ids, visible, color, threshold=DEFAULT_THRESHOLD):
+    # ids and visible are (width, height) arrays of the primary hits, color is the (width, height, 3) backbuffer
+    # returns a (width, height) mask of the pixels that are on an edge
+    edges = np.zeros(ids.shape, dtype=bool)
+    for axis in (0, 1):
+        ahead = [slice(None)] * 2
+        behind = [slice(None)] * 2
+        ahead[axis], behind[axis] = slice(1, None), slice(None, -1)
+        ahead, behind = tuple(ahead), tuple(behind)
+
+        # pixels next to each other along this axis that don't look alike, both of them are on the edge
+        differs = (ids[ahead] != ids[behind]) | (visible[ahead] != visible[behind])
+        differs |= np.abs(color[ahead].astype(float) - color[behind]).max(axis=-1) > threshold
+        edges[ahead] |= differs
+        edges[behind] |= differs
+
+    return edges
+
+def grow(mask):
+    # the pixels of mask and their 4 neighbours
+    grown = mask.copy()
+    grown[1:] |= mask[:-1]
+    grown[:-1] |= mask[1:]
+    grown[:, 1:] |= mask[:, :-1]
+    grown[:, :-1] |= mask[:, 1:]
+    return grown
+
+def subpixel_coordinates(x, y, camera, samples):
+    # the viewport coordinates of a samples x samples grid inside of each pixel (x, y), as flat arrays
+    # with the samples of a pixel next to each other
+    xs, ys = camera.viewport.coordinates[1], camera.viewport.coordinates[0]
+    width = xs[1] - xs[0] if len(xs) > 1 else 0.0
+    height = ys[1] - ys[0] if len(ys) > 1 else 0.0
+
+    grid = (np.arange(samples) + 0.5) / samples - 0.5
+    offset_x, offset_y = np.meshgrid(grid * width, grid * height, indexing='ij')
+    return (x[:, None] + offset_x.ravel()).ravel(), (y[:, None] + offset_y.ravel()).ravel()
@@ -0,0 +1,58 @@
+import math
+import numpy as np
+
+# Decides when a reflection path isn't worth following any further.
+# Every bounce adds its color * lightning weighted by the throughput, the product of reflection * lightning of the bounces
+# before it. A single bounce can't add more than 255 * limit to a color channel per unit of throughput,
+# where limit is the lightning of a point right on the surface of every light at once,
+# so once throughput * 255 * limit is at or below epsilon the rest of the path is dropped.
+# With the default epsilon of 0 that only drops paths that can't add anything at all (a shadowed or non-reflective bounce),
+# which leaves the image as it is.
+# Russian roulette goes further: a path whose next bounce could add less than roulette survives with a probability of
+# that contribution / roulette and carries its throughput divided by that probability, so the expected color stays the same.
+# The draws of a tile come from a generator seeded with the seed and the tile (see for_tile), a copy of the object that was
+# pickled into a worker process would otherwise draw the same numbers as every other copy, and a tile gives the same
+# result whichever process renders it.
+
+class Termination:
+    def __init__(self, epsilon=0.0, roulette=0.0, seed=None):
+        self.epsilon = epsilon
+        self.roulette = roulette
+        self.seed = seed if seed is not None else np.random.SeedSequence().entropy
+        self.rng = np.random.default_rng(self.seed)
+
+    def for_tile(self, tile):
+        # the termination to render a tile (x_start, x_end, y_start, y_end) with, only roulette needs a generator of its own
+        if self.roulette <= 0:
+            return self
+
+        termination = Termination(self.epsilon, self.roulette, self.seed)
+        termination.rng = np.random.default_rng([self.seed] + [int(bound) for bound in tile])
+        return termination
+
+    def limit(self, lights):
+        # the most a bounce can add to a color channel per unit of throughput
+        if not lights:
+            return 0.0
+
+        intensity = sum(light.intensity for light in lights)
+        radius = min(light.radius for light in lights)
+        return 255 * intensity / (4*math.pi*math.sqrt(radius))
+
+    def apply(self, throughput, limit):
+        # takes the throughput of one or more paths, returns which of them go on and their throughput from now on
+        contribution = throughput * limit
+        going = contribution > self.epsilon
+
+        if self.roulette > 0:
+            survival = np.minimum(1.0, contribution / self.roulette)
+            going &= self.rng.random(np.shape(throughput)) < survival
+            with np.errstate(divide='ignore', invalid='ignore'):
+                throughput = np.where(going, throughput / survival, throughput)
+
+        return going, throughput
+
+    def __str__(self):
+        return "epsilon {0}, roulette {1}".format(self.epsilon, self.roulette if self.roulette > 0 else "off")
+
+DEFAULT_TERMINATION = Termination()
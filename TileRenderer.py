@@ -0,0 +1,287 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from Ray import calculate_pixel
+from PathBuffer import PathBuffer
+from Supersampling import subpixel_coordinates
+from ScreenBins import ScreenBins
+import BatchRenderer
+import Profiler
+
+# Multi-core renderer: the viewport is split up into tiles which are handed out to a pool of worker processes.
+# The backbuffer lives in shared memory so workers write their pixels straight into it,
+# the only thing sent back to the main process is which tile was finished.
+# A worker that dies (crashes, gets killed) breaks the pool, the frame then fails with BrokenProcessPool instead of
+# waiting forever for its tile, and the next frame starts a new pool.
+
+TILE_SIZE = 32
+
+def make_tiles(width, height, tile_size=TILE_SIZE):
+    # tiles are stored as (x_start, x_end, y_start, y_end), in the order they appear on screen
+    tiles = []
+    for y_start in range(0, height, tile_size):
+        for x_start in range(0, width, tile_size):
+            tiles.append((x_start, min(x_start + tile_size, width), y_start, min(y_start + tile_size, height)))
+
+    return tiles
+
+def render_tile(tile, camera, scene, depth, batch, step=1, mask=None, record=False, termination=None, samples=1, candidates=None):
+    # renders a single tile, the result is indexed as [x, y] like the backbuffer
+    # with a step above 1 only every step-th pixel is traced and copied into a step x step block (for quick previews)
+    # with a mask only the pixels of the tile where it's set are traced, and their colors are returned as (K, 3)
+    # with record the IDs, distances and visible lights of the hits along the path of every pixel are returned as well, see PathBuffer.py
+    # with samples above 1 every pixel is the average of samples x samples rays spread over its area (see Supersampling.py), this doesn't record
+    # candidates is an optional array of the only object IDs the primary rays of the tile can hit (see ScreenBins.py)
+    x_start, x_end, y_start, y_end = tile
+    xs = camera.viewport.coordinates[1][x_start:x_end:step]
+    ys = camera.viewport.coordinates[0][y_start:y_end:step]
+    x, y = np.meshgrid(xs, ys, indexing='ij')
+    x, y = (x[mask], y[mask]) if mask is not None else (x.ravel(), y.ravel())
+    pixels = len(x)
+    if termination is not None:
+        termination = termination.for_tile(tile)
+    if samples > 1:
+        x, y = subpixel_coordinates(x, y, camera, samples)
+
+    profiler = Profiler.active
+    cost = np.zeros(len(x)) if profiler else None
+
+    if record:
+        path_ids = np.full((len(x), depth + 1), -1, dtype=np.int32)
+        path_distances = np.full((len(x), depth + 1), np.inf)
+        path_visible = np.zeros((len(x), depth + 1), dtype=np.uint64)
+
+    if batch:
+        color = BatchRenderer.render_coordinates(x, y, camera, scene, depth, cost, (path_ids, path_distances, path_visible) if record else None,
+                                                 termination=termination, candidates=candidates)
+    else:
+        if candidates is not None:
+            scene_objects = scene.get_all_scene_objects()
+            candidates = [scene_objects[idx] for idx in candidates.tolist()]
+
+        color = np.zeros((len(x), 3))
+        for idx in range(len(x)):
+            if profiler:
+                rays = profiler.total_rays()
+
+            path = [] if record else None
+            color[idx] = calculate_pixel(x[idx], y[idx], camera, scene, depth, path, termination, candidates)
+
+            if profiler:
+                cost[idx] = profiler.total_rays() - rays
+
+            if record:
+                for bounce, hit_data in enumerate(path):
+                    if hit_data:
+                        path_ids[idx, bounce], path_distances[idx, bounce] = hit_data.geometry.id, hit_data.distance
+                        path_visible[idx, bounce] = hit_data.visible_lights & ((1 << BatchRenderer.VISIBILITY_BITS) - 1)
+
+    if samples > 1:
+        color = color.reshape((pixels, samples * samples, 3)).mean(axis=1)
+        if profiler:
+            cost = cost.reshape((pixels, samples * samples)).sum(axis=1)
+
+    if mask is None:
+        color = color.reshape((len(xs), len(ys), 3))
+        if profiler:
+            cost = cost.reshape((len(xs), len(ys)))
+        if record:
+            path_ids = path_ids.reshape((len(xs), len(ys), depth + 1))
+            path_distances = path_distances.reshape((len(xs), len(ys), depth + 1))
+            path_visible = path_visible.reshape((len(xs), len(ys), depth + 1))
+    elif profiler:
+        tile_cost = np.zeros(mask.shape)
+        tile_cost[mask] = cost
+        cost = tile_cost
+
+    if step > 1:
+        color = np.repeat(np.repeat(color, step, axis=0), step, axis=1)[:x_end - x_start, :y_end - y_start]
+        if profiler:
+            # the rays were traced for the top left pixel of every block
+            block_cost = np.zeros((x_end - x_start, y_end - y_start))
+            block_cost[::step, ::step] = cost
+            cost = block_cost
+
+    if profiler:
+        profiler.add_cost(x_start, y_start, cost)
+
+    if record:
+        return color, path_ids, path_distances, path_visible
+
+    return color
+
+def make_tasks(tiles, camera, scene, step, dirty, task):
+    # the tasks of the tiles that have something to trace, made by task(tile, mask, candidates) where candidates are
+    # the objects its primary rays can hit (see ScreenBins.py), the ones with the most objects to test per pixel come first
+    # so a slow tile doesn't end up holding up the end of the frame
+    # a BVH is faster than the candidates of a tile, so with one there are none and the tiles with the most pixels come first
+    compiled = scene.compile()
+    bins = ScreenBins(camera, compiled) if compiled.bvh is None else None
+    tasks = []
+    for tile in tiles:
+        x_start, x_end, y_start, y_end = tile
+        mask = dirty[x_start:x_end, y_start:y_end] if dirty is not None else None
+        if mask is None or mask.any():
+            candidates = bins.candidates(tile) if bins else None
+            pixels = np.count_nonzero(mask) if mask is not None else len(range(x_start, x_end, step)) * len(range(y_start, y_end, step))
+            tasks.append((len(candidates) * pixels if bins else pixels, task(tile, mask, candidates)))
+
+    tasks.sort(key=lambda task: task[0], reverse=True)
+    return [task for _, task in tasks]
+
+def store(backbuffer, tile, color, mask=None):
+    # writes the colors render_tile returned for a tile into the backbuffer,
+    # a backbuffer of integers (see Checkpoint.py) gets them rounded the way pygame rounds a screenshot
+    x_start, x_end, y_start, y_end = tile
+    if np.issubdtype(backbuffer.dtype, np.integer):
+        color = np.rint(color)
+
+    if mask is None:
+        backbuffer[x_start:x_end, y_start:y_end] = color
+    else:
+        backbuffer[x_start:x_end, y_start:y_end][mask] = color
+
+def open_backbuffer(buffer):
+    # buffer is either (shared memory name, shape) or the path of a memory mapped .npy file,
+    # returns the shared memory (None for a file) and the backbuffer
+    if isinstance(buffer, str):
+        return None, np.load(buffer, mmap_mode='r+')
+
+    name, shape = buffer
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+
+# state of a worker process, set up once by init_worker so the scene isn't pickled for every tile
+_worker = {}
+
+def init_worker(buffer, scene, batch, termination, frame, paths):
+    # keep a reference to the shared memory, otherwise the buffer is released
+    _worker['shm'], _worker['backbuffer'] = open_backbuffer(buffer)
+    _worker['scene'] = scene
+    _worker['batch'] = batch
+    _worker['termination'] = termination
+    _worker['frame'] = frame
+
+    # (depth, shared memory names) of the path buffer of the main process, if it keeps one
+    if paths:
+        depth, names = paths
+        width, height = _worker['backbuffer'].shape[:2]
+        _worker['paths'] = PathBuffer(width, height, depth, shared=True, names=names)
+    else:
+        _worker['paths'] = None
+
+def work_tile(task):
+    tile, camera, depth, step, mask, samples, profile, frame, candidates = task
+    x_start, x_end, y_start, y_end = tile
+
+    # the frame was cancelled (the camera moved), don't bother with what's left of it
+    if frame != _worker['frame'].value:
+        return tile, None
+
+    # a profiler per tile, sent back to be merged into the one of the main process
+    if profile:
+        Profiler.start(x_end - x_start, y_end - y_start, x_start, y_start)
+
+    paths = _worker['paths'] if step == 1 and samples == 1 else None
+    result = render_tile(tile, camera, _worker['scene'], depth, _worker['batch'], step, mask, paths is not None, _worker['termination'], samples,
+                         candidates)
+    color = result[0] if paths else result
+
+    if frame == _worker['frame'].value:
+        store(_worker['backbuffer'], tile, color, mask)
+        if paths:
+            paths.write(tile, *result[1:], mask)
+
+    return tile, Profiler.stop()
+
+class TileRenderer:
+    def __init__(self, workers, width, height, batch=False, tile_size=TILE_SIZE, depth=None, termination=None, backbuffer=None):
+        # with a depth the workers also record the paths of their pixels into a shared PathBuffer of that depth
+        # backbuffer is an optional memory mapped backbuffer (see Checkpoint.py) for the workers to write to,
+        # otherwise one is made in shared memory
+        self.workers = workers
+        self.batch = batch
+        self.termination = termination
+        self.tiles = make_tiles(width, height, tile_size)
+
+        if backbuffer is not None:
+            self.shm = None
+            self.backbuffer = backbuffer
+            self.buffer = backbuffer.filename
+        else:
+            shape = (width, height, 3)
+            self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(np.float64).itemsize)
+            self.backbuffer = np.ndarray(shape, dtype=np.float64, buffer=self.shm.buf)
+            self.backbuffer[:] = 0
+            self.buffer = (self.shm.name, shape)
+        self.paths = PathBuffer(width, height, depth, shared=True) if depth is not None else None
+
+        self.context = mp.get_context('spawn')
+        self.frame = self.context.Value('i', 0, lock=False) # bumped after every render, so tiles of a cancelled one get skipped
+        self.pool = None
+        self.scene = None
+
+    def set_scene(self, scene):
+        # the scene is handed to the workers once when the pool starts, so a new scene means a new pool
+        if scene is self.scene:
+            return
+
+        self.shutdown()
+
+        self.scene = scene
+        # spawn instead of fork, forking a process that has already initialized pygame/SDL can deadlock the workers
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=self.context, initializer=init_worker,
+                                        initargs=(self.buffer, scene, self.batch, self.termination, self.frame,
+                                                  (self.paths.depth, self.paths.names()) if self.paths else None))
+
+    def shutdown(self):
+        # tiles that are being rendered still finish, they see that the frame moved on and don't write anything
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def render(self, camera, scene, depth, step=1, dirty=None, samples=1):
+        # generator that yields every tile as soon as a worker has written it into the backbuffer
+        # closing the generator before it's done cancels the tiles that haven't been started yet
+        # dirty is an optional (width, height) mask of the only pixels to trace, tiles without any of them are skipped
+        # samples is passed on to render_tile
+        self.set_scene(scene)
+
+        profiler = Profiler.active
+        frame = self.frame.value
+        tasks = make_tasks(self.tiles, camera, scene, step, dirty,
+                           lambda tile, mask, candidates: (tile, camera, depth, step, mask, samples, profiler is not None, frame, candidates))
+
+        # one task per tile so tiles are scheduled dynamically, expensive tiles (reflections, the checker plane)
+        # then don't hold up a worker that was handed a whole batch of them
+        futures = [self.pool.submit(work_tile, task) for task in tasks]
+        try:
+            for future in as_completed(futures):
+                tile, tile_profiler = future.result()
+                if profiler:
+                    profiler.merge(tile_profiler)
+                yield tile
+        except BrokenProcessPool:
+            self.shutdown()
+            self.scene = None
+            raise
+        finally:
+            self.frame.value += 1
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+        self.backbuffer = None
+        if self.shm:
+            self.shm.close()
+            self.shm.unlink()
+
+        if self.paths:
+            self.paths.close()
@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+
+from Scene import Scene
+from Camera import Camera
+from Intersectable import *
+from Ray import Ray, Hit
+from SceneParser import load_scene_file
+from TileRenderer import render_tile
+from Termination import Termination
+import Profiler
+
+# Headless benchmark, renders a fixed matrix of scenes, resolutions and reflection depths without opening a window
+# and reports wall time, rays per second and peak memory as JSON.
+# Run with: python benchmark.py -o results.json
+# Compare against an earlier run with: python benchmark.py -baseline results.json
+# Time the vector math of the scalar renderer against the NumPy functions of utility.py with: python benchmark.py -micro
+
+SCENES = ["scenes/scene01.scene", "scenes/manyspheres.scene", "synthetic:100", "synthetic:1000"]
+RESOLUTIONS = ["160x120", "320x240"]
+DEPTHS = [1, 3]
+
+def synthetic_scene(count, lights=2, seed=0):
+    # a checker plane, two lights and count randomly placed spheres in front of the camera
+    # with more lights than two they're spread out above the scene, sharing the intensity of the two
+    rng = np.random.default_rng(seed)
+    scene = Scene(default=False)
+
+    for _ in range(count):
+        center = rng.uniform((-8.0, -0.5, -20.0), (8.0, 6.0, -3.0))
+        radius = rng.uniform(0.1, 0.6)
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        scene.add_object(Sphere(center=tuple(center), radius=radius, material=Material(rng.uniform(0.0, 1.0), color)))
+
+    scene.add_object(Plane(origin=(0.0, -1.0, 0.0), normal=(0, 1, 0), material=Material(1.0, None)))
+
+    if lights <= 2:
+        scene.add_light(Light(position=(4.0, 3.0, -4.0), intensity=8.0, material=Material(0.0, (255, 255, 255))))
+        scene.add_light(Light(position=(-4.0, 4.0, 2.0), intensity=7.0, material=Material(0.0, (255, 255, 255))))
+        return scene
+
+    for _ in range(lights):
+        position = rng.uniform((-30.0, 2.0, -50.0), (30.0, 10.0, 5.0))
+        scene.add_light(Light(position=tuple(position), intensity=15.0 / lights, material=Material(0.0, (255, 255, 255))))
+    return scene
+
+def load_benchmark_scene(name):
+    if name.startswith("synthetic:"):
+        # synthetic:spheres or synthetic:spheres:lights
+        return synthetic_scene(*[int(count) for count in name.split(":")[1:]])
+
+    return load_scene_file(name)
+
+def render(camera, scene, depth, renderer, termination):
+    width, height = len(camera.viewport.coordinates[1]), len(camera.viewport.coordinates[0])
+    return render_tile((0, width, 0, height), camera, scene, depth, renderer == "batch", termination=termination)
+
+def run_case(scene, width, height, depth, renderer, repeat, memory, termination):
+    camera = Camera((0.0, 0.0, 1.0), (0.0, 0.5, -1.0), width, height)
+
+    # the rays are counted in a run of their own so the profiler doesn't add to the timings
+    Profiler.start(width, height)
+    render(camera, scene, depth, renderer, termination)
+    profiler = Profiler.stop()
+
+    # best of repeat runs
+    seconds = np.inf
+    for _ in range(repeat):
+        start_counter = perf_counter()
+        render(camera, scene, depth, renderer, termination)
+        seconds = min(seconds, perf_counter() - start_counter)
+
+    result = {
+        "seconds": seconds,
+        "primary_rays": profiler.primary_rays,
+        "shadow_rays": profiler.shadow_rays,
+        "reflection_rays": profiler.reflection_rays,
+        "primary_rays_per_second": profiler.primary_rays / seconds,
+        "shadow_rays_per_second": profiler.shadow_rays / seconds,
+        "reflection_rays_per_second": profiler.reflection_rays / seconds,
+        "rays_per_second": profiler.total_rays() / seconds,
+    }
+
+    if memory:
+        # tracing slows down allocations, so memory gets its own run instead of skewing the timings
+        tracemalloc.start()
+        render(camera, scene, depth, renderer, termination)
+        result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+
+    return result
+
+class ArrayRecord:
+    # a ray or sphere the way the NumPy functions of utility.py take them
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+def micro_cases():
+    # (name, NumPy version, plain float version) of every primitive the scalar renderer calls per ray
+    a, b = (0.3, -0.8, 0.52), (-0.1, 0.7, 1.3)
+    array_a, array_b = np.array(a), np.array(b)
+    normal = normalize3(b)
+    array_normal = np.array(normal)
+
+    sphere = Sphere(center=(0.0, 1.0, -6.0), radius=2.0, material=Material(1.0, (255, 0, 0)))
+    plane = Plane(origin=(0.0, -1.0, 0.0), normal=(0, 1, 0), material=Material(1.0, None))
+    ray = Ray((0.0, 0.5, 1.0), normalize3((0.05, 0.1, -1.0)))
+    array_ray = ArrayRecord(origin=np.array(ray.origin), direction=np.array(ray.direction))
+    array_sphere = ArrayRecord(origin=np.array(sphere.origin), radius=sphere.radius)
+    array_plane_origin = np.array(plane.origin)
+    distance = sphere.intersect_test(ray)
+
+    def array_plane():
+        # Plane.intersect_test the way it was before it took tuples
+        d = -((array_ray.origin[1] - array_plane_origin[1]) / array_ray.direction[1])
+        return d if 0.001 < d < 1e6 else None
+
+    def array_hit():
+        # Ray and Hit with NumPy vectors, which worked out the normal up front
+        intersection = array_ray.origin + array_ray.direction * distance
+        return intersection, normalize(intersection - array_sphere.origin)
+
+    return [
+        ("dot", lambda: np.dot(array_a, array_b), lambda: dot3(a, b)),
+        ("length", lambda: length(array_a), lambda: length3(a)),
+        ("normalize", lambda: normalize(array_a), lambda: normalize3(a)),
+        ("reflect", lambda: reflect(array_a, array_normal), lambda: reflect3(a, normal)),
+        ("sphere intersection", lambda: solve_quadratic_equation(array_ray, array_sphere), lambda: sphere.intersect_test(ray)),
+        ("plane intersection", array_plane, lambda: plane.intersect_test(ray)),
+        ("ray + hit", array_hit, lambda: Hit(distance, sphere, Ray(ray.origin, ray.direction).intersection(distance))),
+    ]
+
+def run_micro(number, repeat):
+    # nanoseconds per call of every primitive, best of repeat runs of number calls
+    results = []
+    print("%-20s %10s %10s %8s" % ("primitive", "numpy ns", "float ns", "speedup"))
+    for name, array_version, float_version in micro_cases():
+        array_ns = min(timeit.repeat(array_version, number=number, repeat=repeat)) / number * 1e9
+        float_ns = min(timeit.repeat(float_version, number=number, repeat=repeat)) / number * 1e9
+        results.append({"name": name, "numpy_ns": array_ns, "float_ns": float_ns, "speedup": array_ns / float_ns})
+        print("%-20s %10.0f %10.0f %7.1fx" % (name, array_ns, float_ns, array_ns / float_ns))
+
+    return results
+
+def compare(results, baseline, threshold):
+    # returns the names of the cases that got slower than the baseline by more than threshold (0.1 = 10%)
+    baseline = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+
+    print("\n%-45s %10s %10s %8s" % ("case", "baseline", "current", "change"))
+    for result in results:
+        old = baseline.get(result["name"])
+        if old is None:
+            print("%-45s %10s %10.3f %8s" % (result["name"], "-", result["seconds"], "new"))
+            continue
+
+        change = result["seconds"] / old["seconds"] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(result["name"])
+
+        print("%-45s %10.3f %10.3f %+7.1f%% %s" % (result["name"], old["seconds"], result["seconds"], change * 100, "REGRESSION" if regressed else ""))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless ray tracing benchmark")
+    parser.add_argument('-scenes', nargs='+', default=SCENES, help="Scene files, or synthetic:N for N random spheres (synthetic:N:L with L lights)")
+    parser.add_argument('-resolutions', nargs='+', default=RESOLUTIONS, help="Viewport sizes as WIDTHxHEIGHT")
+    parser.add_argument('-depths', nargs='+', type=int, default=DEPTHS, help="Max reflection depths")
+    parser.add_argument('-renderer', choices=('batch', 'scalar'), default='batch', help="Which render path to measure")
+    parser.add_argument('-bvh', choices=('sah', 'median'), help="Build a BVH for every scene")
+    parser.add_argument('-epsilon', type=float, default=0.0, help="Path termination threshold, see Termination.py")
+    parser.add_argument('-roulette', type=float, default=0.0, help="Russian roulette threshold, see Termination.py")
+    parser.add_argument('-lighterror', type=float, default=0.0, help="Error bound of the light culling and clustering, see LightTree.py")
+    parser.add_argument('-shadowmap', type=int, default=0, help="Resolution of the shadow maps of the lights, see ShadowMap.py")
+    parser.add_argument('-repeat', type=int, default=1, help="Render every case this many times and keep the fastest")
+    parser.add_argument('-nomem', help="Skip measuring peak memory", action='store_true')
+    parser.add_argument('-o', metavar='path', type=str, help="Write the results as JSON to path")
+    parser.add_argument('-baseline', metavar='path', type=str, help="Compare against the results of an earlier run")
+    parser.add_argument('-threshold', type=float, default=0.1, help="Slowdown compared to the baseline that counts as a regression")
+    parser.add_argument('-micro', help="Only time the vector math of the scalar renderer against the NumPy versions", action='store_true')
+    args = parser.parse_args()
+
+    if args.micro:
+        output = {"micro": run_micro(100000, max(args.repeat, 5))}
+        if args.o:
+            with open(args.o, "w") as f:
+                json.dump(output, f, indent=2)
+        return
+
+    results = []
+    for scene_name in args.scenes:
+        scene = load_benchmark_scene(scene_name)
+        scene.compile(args.bvh, args.lighterror, args.shadowmap)
+
+        for resolution in args.resolutions:
+            width, height = [int(size) for size in resolution.split("x")]
+            for depth in args.depths:
+                name = "%s/%s/depth%d/%s" % (os.path.basename(scene_name), resolution, depth, args.renderer)
+                if args.bvh:
+                    name += "/bvh-" + args.bvh
+                if args.epsilon or args.roulette:
+                    name += "/eps%g-rr%g" % (args.epsilon, args.roulette)
+                if args.lighterror:
+                    name += "/lights%g" % args.lighterror
+                if args.shadowmap:
+                    name += "/shadowmap%d" % args.shadowmap
+
+                result = {"name": name, "scene": scene_name, "width": width, "height": height, "depth": depth, "renderer": args.renderer, "bvh": args.bvh,
+                          "epsilon": args.epsilon, "roulette": args.roulette, "light_error": args.lighterror,
+                          "shadow_resolution": args.shadowmap}
+                termination = Termination(args.epsilon, args.roulette, seed=0)
+                result.update(run_case(scene, width, height, depth, args.renderer, args.repeat, not args.nomem, termination))
+                results.append(result)
+
+                print("%-45s %8.3f s %12.0f rays/s" % (name, result["seconds"], result["rays_per_second"]))
+
+    output = {"results": results}
+    if args.o:
+        with open(args.o, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+        if regressions:
+            print("\n%d case(s) regressed by more than %.0f%%" % (len(regressions), args.threshold * 100))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,164 @@
 from time import perf_counter
 from datetime import datetime
+import copy
 import pygame
 import numpy as np
 
 from utility import *
 from Ray import *
+from BatchRenderer import BATCH_SIZE
+from TileRenderer import TileRenderer, render_tile, store
+from Distributed import Coordinator
+from Presenter import Presenter, RenderThread
+from PathBuffer import PathBuffer
+from Checkpoint import Checkpoint
+from Supersampling import find_edges, grow
+from Reprojection import History
+from ScreenBins import ScreenBins
+from SceneParser import cache_key
+from RenderCache import RenderCache
+from DynamicResolution import DynamicQuality
+import Profiler
 from Intersectable import *
 from App import *
 
 WINDOW_WIDTH = 1200
 WINDOW_HEIGHT = 800
 
+# pixel steps of the progressive passes, the first pass only traces one pixel out of every 8x8 block
+PROGRESSIVE_STEPS = [8, 4, 2, 1]
+
+# progress goes from 0 to 1
+def print_progress(progress):
+    percentage = progress * 100
+    if percentage % 10 == 0:
+        print("\rProgress:", "%.2f" % percentage, "%", end='')
+
+def render_passes(app, depth, dirty):
+    # (pixel step, reflection depth) of every pass, each progressive pass is twice as sharp and one reflection deeper
+    # than the last one, the final pass is always the full frame
+    # re-tracing the pixels a scene update touched is done in one go, those are usually few enough
+    if not app.progressive or dirty is not None:
+        return [(1, depth)]
+
+    passes = [(step, min(i, depth)) for i, step in enumerate(PROGRESSIVE_STEPS[:-1])]
+    passes.append((1, depth))
+    return passes
+
+def frame_settings(app):
+    # what changes how a frame looks besides the scene, the camera and the depth, for the render cache
+    return {"termination": str(app.termination), "light_error": app.light_error, "shadow_resolution": app.shadow_resolution, "samples": app.samples,
+            "aa_threshold": app.aa_threshold if app.samples > 1 else None}
+
+def render_frame(app, camera, scene, depth, backbuffer, tile_renderer, paths, dirty=None, relight=False, history=None, moved=False):
+    # generator that renders a frame and yields the progress (0 to 1) and the region (x_start, x_end, y_start, y_end)
+    # of every finished block of rows or tile, closing it cancels the rest of the frame
+    # with a dirty mask only the pixels where it's set are traced again, the rest of the backbuffer is kept
+    # with relight nothing is traced, the paths of the last frame are shaded again with the materials and lights of scene
+    # with a history (-reproject) and a camera that moved, the last frame is reprojected first and the progress starts over
+    # for tracing the pixels that are stale and then again for refining the rest (see Reprojection.py)
+    # with -aa the pixels on edges are supersampled afterwards, and the progress starts over for that (see Supersampling.py)
+    if relight:
+        rows_per_block = max(1, BATCH_SIZE // app.viewport_width)
+        for y_start in range(0, app.viewport_height, rows_per_block):
+            y_end = min(y_start + rows_per_block, app.viewport_height)
+            block = (0, app.viewport_width, y_start, y_end)
+            store(backbuffer, block, paths.relight(block, camera, scene))
+            if history is not None:
+                history.record(block, camera, scene.compile(), paths, backbuffer) # same hits, new colors
+            yield y_end / app.viewport_height, block
+    elif moved and history is not None:
+        stale = history.reproject(backbuffer, camera)
+        print("\rReprojected the last frame, tracing", np.count_nonzero(stale), "of", stale.size, "pixels first")
+        yield 0.0, (0, app.viewport_width, 0, app.viewport_height)
+        yield from trace_frame(app, camera, scene, [(1, depth)], backbuffer, tile_renderer, paths, stale, history=history)
+        yield from trace_frame(app, camera, scene, [(1, depth)], backbuffer, tile_renderer, paths, ~stale, history=history)
+    else:
+        yield from trace_frame(app, camera, scene, render_passes(app, depth, dirty), backbuffer, tile_renderer, paths, dirty, history=history)
+
+    if app.samples > 1:
+        edges = find_edges(paths.ids[:, :, 0], paths.visible[:, :, 0], backbuffer, app.aa_threshold)
+        if dirty is not None:
+            edges &= grow(dirty) # the rest of the edges were supersampled with the last frame
+        count = np.count_nonzero(edges)
+        print("\rSupersampling", count, "edge pixels with", count * app.samples**2, "extra rays,",
+              "%.1f%% of supersampling every pixel" % (100 * count / edges.size))
+        yield from trace_frame(app, camera, scene, [(1, depth)], backbuffer, tile_renderer, paths, edges, app.samples)
+
+def trace_frame(app, camera, scene, passes, backbuffer, tile_renderer, paths, dirty=None, samples=1, history=None):
+    # the tracing part of render_frame, passes are the (pixel step, reflection depth) of every pass
+    # the primary hits of every recorded region go into history
+    def traced(region, step):
+        # amount of pixels traced for a region
+        x_start, x_end, y_start, y_end = region
+        if dirty is not None:
+            return np.count_nonzero(dirty[x_start:x_end, y_start:y_end])
+        return len(range(x_start, x_end, step)) * len(range(y_start, y_end, step))
+
+    work = sum(traced((0, app.viewport_width, 0, app.viewport_height), step) for step, _ in passes)
+    done = 0
+    # the tile renderers make their own bins, and a BVH is faster for the primary rays of big scenes than the candidates of a block
+    bins = ScreenBins(camera, scene.compile()) if not tile_renderer and scene.compile().bvh is None else None
+
+    for step, pass_depth in passes:
+        if tile_renderer:
+            for tile in tile_renderer.render(camera, scene, pass_depth, step, dirty, samples):
+                if history is not None and paths is not None and step == 1 and samples == 1:
+                    x_start, x_end, y_start, y_end = tile
+                    history.record(tile, camera, scene.compile(), paths, backbuffer, dirty[x_start:x_end, y_start:y_end] if dirty is not None else None)
+                done += traced(tile, step)
+                yield done / work, tile
+            continue
+
+        # the scalar renderer goes row by row, the vectorized one renders a block of rows at a time
+        rows_per_block = max(1, BATCH_SIZE * step // app.viewport_width) if app.batch else 1
+        rows_per_block *= step # blocks have to line up with the pixel step
+        for y_start in range(0, app.viewport_height, rows_per_block):
+            y_end = min(y_start + rows_per_block, app.viewport_height)
+            block = (0, app.viewport_width, y_start, y_end)
+            mask = dirty[:, y_start:y_end] if dirty is not None else None
+            if mask is not None and not mask.any():
+                continue
+
+            # only full resolution passes are recorded
+            record = paths is not None and step == 1 and samples == 1
+            result = render_tile(block, camera, scene, pass_depth, app.batch, step, mask, record, app.termination, samples,
+                                 bins.candidates(block) if bins else None)
+            color = result[0] if record else result
+            store(backbuffer, block, color, mask)
+
+            if record:
+                paths.write(block, *result[1:], mask)
+                if history is not None:
+                    history.record(block, camera, scene.compile(), paths, backbuffer, mask)
+
+            done += traced(block, step)
+            yield done / work, block
+
+def render_in_background(app, frame, presenter, backbuffer, camera):
+    # renders the frame on a worker thread while this one handles input and refreshes the window on a fixed budget
+    # returns whether the frame was finished, whether the camera moved and the camera
+    # a frame that failed (e.g. a tile worker died, see TileRenderer.py) isn't finished, so it's neither kept nor cached
+    thread = RenderThread(frame, presenter)
+    thread.start()
+
+    while thread.is_alive():
+        # moving the camera (or quitting) throws away the rest of the frame
+        render, camera = app.process_events(camera)
+        if render or not app.running:
+            thread.cancel()
+            return False, render, camera
+
+        presenter.present(backbuffer, camera, thread.progress)
+        presenter.wait()
+
+    thread.join()
+    presenter.present(backbuffer, camera, thread.progress, force=True)
+    if thread.error is not None:
+        print("\nThe frame failed:", repr(thread.error))
+        return False, False, camera
+    return True, False, camera
+
 def main():
     app = App(WINDOW_WIDTH, WINDOW_HEIGHT, "Ray tracing")
     pygame.init()
@@ -26,10 +174,54 @@ def main():
     # A pixel-array with 3 values for each pixel (RGB)
     # Essential this is a Width x Height with a depth of 3
     # PyGame will read the backbuffer as [X, Y], hence why WIDTH is being used to determine the rows of the matrix
-    backbuffer = np.zeros((app.viewport_width, app.viewport_height, 3))
+    # when the scene file is being watched for changes, the paths of every pixel are kept so an update of the file
+    # only re-traces the pixels that it affects (see PathBuffer.py), supersampling the edges of a frame needs them as well
+    # with -checkpoint the backbuffer is a file instead, and whatever an earlier run of the same render left in it is kept (see Checkpoint.py)
+    watching = app.scene_path is not None and not app.headless
+    recording = watching or app.samples > 1 or app.reproject
+    checkpoint = None
+    if app.checkpoint:
+        settings = {"scene": cache_key(app.scene_path) if app.scene_path else None, "position": camera.position.tolist(),
+                    "look_to": camera.look_to.tolist(), "depth": app.max_depth, "termination": str(app.termination),
+                    "light_error": app.light_error, "shadow_resolution": app.shadow_resolution}
+        checkpoint = Checkpoint(app.checkpoint, app.viewport_width, app.viewport_height, app.checkpoint_type, settings)
+
+    history = History(app.viewport_width, app.viewport_height) if app.reproject else None
+    cache = RenderCache(app.cache, app.cache_size) if app.cache else None
+    quality = DynamicQuality(app.frame_time, app.viewport_width, app.viewport_height, app.max_depth) if app.frame_time and not app.headless else None
+
+    if app.coordinator:
+        # same as the tile renderer, but the tiles go to workers on other machines (see Distributed.py)
+        tile_renderer = Coordinator(app.coordinator, app.viewport_width, app.viewport_height, batch=app.batch,
+                                    depth=app.max_depth if recording else None, termination=app.termination,
+                                    authkey=app.authkey, local_workers=app.workers, backbuffer=checkpoint.pixels if checkpoint else None)
+        backbuffer = tile_renderer.backbuffer
+        paths = tile_renderer.paths
+    elif app.workers:
+        # the tile renderer owns the backbuffer, it lives in shared memory (or the checkpoint file) so the worker processes can write to it
+        tile_renderer = TileRenderer(app.workers, app.viewport_width, app.viewport_height, batch=app.batch,
+                                     depth=app.max_depth if recording else None, termination=app.termination,
+                                     backbuffer=checkpoint.pixels if checkpoint else None)
+        backbuffer = tile_renderer.backbuffer
+        paths = tile_renderer.paths
+    else:
+        tile_renderer = None
+        backbuffer = checkpoint.pixels if checkpoint else np.zeros((app.viewport_width, app.viewport_height, 3))
+        paths = PathBuffer(app.viewport_width, app.viewport_height, app.max_depth) if recording else None
     framebuffer = app.create_framebuffer()
+    presenter = Presenter(framebuffer, font, app.viewport_width, app.viewport_height) if not app.headless else None
     
     render = True
+    dirty = None # pixels to re-trace after a scene update, None for all of them
+    if checkpoint:
+        # a checkpoint is rendered in one pass, only the pixels it doesn't have yet
+        dirty = checkpoint.remaining()
+        if checkpoint.resumed:
+            print("Resuming", app.checkpoint + ",", np.count_nonzero(dirty), "of", dirty.size, "pixels left")
+    relight = False # whether the last scene update only changed the shading
+    moved = False # whether the camera moved since the last full quality frame
+    moving = False # whether the camera is being moved, then frames are scaled down to app.frame_time (see DynamicResolution.py)
+    scaled = False # whether the backbuffer holds such a frame
 
     scene = app.scene
     depth = app.max_depth
@@ -39,36 +231,84 @@ def main():
     while app.running:
         app.running ^= app.headless # run game loop only once if headless mode is turned on
       
+        if render and cache and not moving:
+            # a frame that was rendered before is loaded along with its paths, if it has them
+            key = cache.key(scene.compile(), camera, depth, frame_settings(app))
+            if cache.load(key, backbuffer, paths):
+                print("Loaded the frame from the render cache")
+                if history is not None:
+                    history.clear()
+                    if paths and paths.valid:
+                        history.record((0, app.viewport_width, 0, app.viewport_height), camera, scene.compile(), paths, backbuffer)
+                if presenter:
+                    presenter.present(backbuffer, camera, 1.0, force=True)
+                print(cache.report())
+                dirty, relight, moved, scaled = None, False, False, False
+                render = False
+
         if render:
+            if app.profile:
+                Profiler.start(app.viewport_width, app.viewport_height)
+
             start_counter = perf_counter()
-            # y_index and x_index are indices used for the pixel array and y and x are the viewport coordinates 
-            for y_index, y in enumerate(camera.viewport.coordinates[0]):
-                for x_index, x in enumerate(camera.viewport.coordinates[1]):
-                    backbuffer[x_index, y_index] = calculate_pixel(x, y, camera, scene, depth)
-
-                if not app.headless:
-                    # create an upscaled version of our frame
-                    surface_backbuffer = pygame.surfarray.make_surface(backbuffer)
-                    backbuffer_smooth_upscaled = pygame.transform.smoothscale(surface_backbuffer, (app.window_width, app.window_height))
-                    #center_x, center_y = (int(app.window_width/4), int((app.window_height/4)))
-                    
-                    framebuffer.blit(backbuffer_smooth_upscaled, ((0, 0)))
-                    
-                    text, textrect = print_camera_info(camera, font)
-                    framebuffer.blit(text, textrect)
-
-                    text, textrect = progress_text(y_index, font, app.window_width, app.window_height)
-                    framebuffer.blit(text, textrect)
-
-                    pygame.display.update()
-                else:
-                    percentage = ((y_index+1) / (app.viewport_height)) * 100
-                    if percentage % 10 == 0:
-                        print("\rProgress:", "%.2f" % percentage, "%", end='')
+
+            if paths:
+                paths.valid = False
+
+            # the frame gets a camera of its own, the input handling moves camera while the render thread traces
+            frame_camera = copy.deepcopy(camera)
+            if moving:
+                # a single pass at whatever fits in the target frame time, nothing is recorded for it
+                level = quality.level()
+                frame = quality.timed(trace_frame(app, frame_camera, scene, [level], backbuffer, tile_renderer, None), level)
+            else:
+                level = (1, depth)
+                frame = render_frame(app, frame_camera, scene, depth, backbuffer, tile_renderer, paths, dirty, relight, history, moved)
+            if presenter:
+                presenter.set_quality(*level)
+
+            if app.headless:
+                for progress, region in frame:
+                    print_progress(progress)
+                    if checkpoint:
+                        checkpoint.finish(region)
+            else:
+                finished, render, camera = render_in_background(app, frame, presenter, backbuffer, camera)
+                if not finished:
+                    if Profiler.active:
+                        Profiler.stop()
+                    dirty, relight, moved = None, False, render
+                    moving = render and quality is not None
+                    continue
     
             end_counter = perf_counter()
             elapsed_seconds = (end_counter - start_counter)
             print("\nIt took", elapsed_seconds, "seconds to render")
+
+            if moving:
+                # moved stays set, the full quality frame once the camera stops can start from the last one reprojected
+                print("Scaled down to a pixel step of %d and a depth of %d" % level)
+                dirty, relight, scaled = None, False, True
+            else:
+                if paths:
+                    paths.valid = True
+                dirty, relight, moved, scaled = None, False, False, False
+
+            if cache and not moving:
+                cache.store(key, backbuffer, paths)
+                print(cache.report())
+
+            if scene.compiled.bvh and not app.workers:
+                # the workers have their own copy of the BVH, so there's only something to report when rendering here
+                print(scene.compiled.bvh.report())
+                scene.compiled.bvh.reset_stats()
+
+            if app.profile:
+                profiler = Profiler.stop()
+                print(profiler.summary(scene, elapsed_seconds))
+                if app.heatmap:
+                    pygame.image.save(pygame.surfarray.make_surface(profiler.heatmap()), app.heatmap)
+                    print("Saved ray cost heatmap to", app.heatmap)
             render = False
 
             # end of render
@@ -79,12 +319,36 @@ def main():
             pygame.image.save(screenshotbuffer, "screenshots/" + datetime.now().strftime('%Y-%m-%d-%H-%M-%S') + ".png")        
 
         render, camera = app.process_events(camera)
+        moving = render and quality is not None
+        moved = moved or render
+        if render and paths:
+            paths.valid = False # the paths were traced from where the camera was before
+        if scaled and not render:
+            render = True # the camera stopped, render the scaled down frame again at full quality
             
         if app.check_for_scene_update():
-            scene = app.scene
+            old_scene, scene = scene, app.scene
+            relight = paths is not None and paths.can_relight(old_scene.compiled, scene.compiled, app.termination)
+            if relight:
+                print("Scene changed, only the shading is different, relighting the last frame")
+            elif paths:
+                dirty = paths.update(old_scene.compiled, scene.compiled, camera)
+                if dirty is not None:
+                    print("Scene changed, re-tracing", np.count_nonzero(dirty), "of", dirty.size, "pixels")
             render = True
+            moved = False
+            if history is not None:
+                # the history is of the old scene, a frame that is cancelled before it recorded the new one
+                # would otherwise reproject it, the update records the pixels it renders again
+                history.clear()
 
         # end of game loop
+
+    if tile_renderer:
+        tile_renderer.close()
+
+    if checkpoint:
+        checkpoint.close()
         
 # end of main    
 if __name__ == '__main__':
@@ -0,0 +1,92 @@
+import argparse
+import itertools
+import json
+import os
+from time import perf_counter
+
+from Camera import Camera
+from SceneParser import load_scene_file
+from TileRenderer import render_tile
+from Termination import Termination
+from PNG import write_png
+
+# Batch renderer for render farms, renders a list of jobs in one process without pygame or a window.
+# Every scene is loaded and compiled once, no matter how many jobs use it.
+# Run with: python render_jobs.py jobs.json -o renders
+#
+# The job list is a JSON file with a list of jobs:
+# {"jobs": [{"scene": "scenes/scene01.scene", "camera": {"position": [0, 0, 1], "look_to": [0, 0.5, -1]},
+#            "resolution": "320x240", "depth": 3}]}
+# Any of scene, camera, resolution and depth can be a list instead, the job then stands for every combination of them.
+# Left out values are the defaults of main.py. Scene paths are relative to the job file.
+# "output" names the image of a job, it can use {scene}, {job}, {width}, {height} and {depth},
+# where job is the number of the combination in the whole list.
+
+DEFAULT_CAMERA = {"position": [0.0, 0.0, 1.0], "look_to": [0.0, 0.5, -1.0]}
+DEFAULT_RESOLUTION = "300x200"
+DEFAULT_DEPTH = 3
+DEFAULT_OUTPUT = "{scene}-{job}.png"
+
+def listed(value):
+    return value if isinstance(value, list) else [value]
+
+def expand_jobs(job_list, base):
+    # every combination of every job as a flat list, in the order of the file
+    jobs = []
+    for job in job_list["jobs"]:
+        combinations = itertools.product(listed(job["scene"]), listed(job.get("camera", DEFAULT_CAMERA)),
+                                         listed(job.get("resolution", DEFAULT_RESOLUTION)), listed(job.get("depth", DEFAULT_DEPTH)))
+        for scene, camera, resolution, depth in combinations:
+            width, height = [int(size) for size in resolution.split("x")]
+            jobs.append({"scene": os.path.join(base, scene), "position": tuple(camera["position"]), "look_to": tuple(camera["look_to"]),
+                         "width": width, "height": height, "depth": depth, "output": job.get("output", DEFAULT_OUTPUT)})
+
+    for idx, job in enumerate(jobs):
+        name = os.path.splitext(os.path.basename(job["scene"]))[0]
+        job["output"] = job["output"].format(scene=name, job=idx, width=job["width"], height=job["height"], depth=job["depth"])
+
+    return jobs
+
+def render_job(job, scene, batch, termination):
+    camera = Camera(job["position"], job["look_to"], job["width"], job["height"])
+    return render_tile((0, job["width"], 0, job["height"]), camera, scene, job["depth"], batch, termination=termination)
+
+def main():
+    parser = argparse.ArgumentParser(description="Renders a list of jobs without opening a window")
+    parser.add_argument('jobs', type=str, help="JSON job list")
+    parser.add_argument('-o', metavar='dir', type=str, default=".", help="Directory the images are written to")
+    parser.add_argument('-scalar', help="Use the scalar renderer instead of the vectorized one", action='store_true')
+    parser.add_argument('-bvh', choices=('sah', 'median'), help="Build a BVH for every scene")
+    parser.add_argument('-epsilon', type=float, default=0.0, help="Path termination threshold, see Termination.py")
+    parser.add_argument('-roulette', type=float, default=0.0, help="Russian roulette threshold, see Termination.py")
+    parser.add_argument('-lighterror', type=float, default=0.0, help="Error bound of the light culling and clustering, see LightTree.py")
+    parser.add_argument('-shadowmap', type=int, default=0, help="Resolution of the shadow maps of the lights, see ShadowMap.py")
+    parser.add_argument('-level', type=int, default=6, help="zlib compression level of the images, 0 to 9")
+    args = parser.parse_args()
+
+    with open(args.jobs) as f:
+        jobs = expand_jobs(json.load(f), os.path.dirname(args.jobs))
+
+    os.makedirs(args.o, exist_ok=True)
+    termination = Termination(args.epsilon, args.roulette)
+    start_counter = perf_counter()
+
+    # jobs of the same scene are done together, so each scene is only loaded once
+    scenes = list(dict.fromkeys(job["scene"] for job in jobs))
+    for scene_path in scenes:
+        scene = load_scene_file(scene_path)
+        scene.compile(args.bvh, args.lighterror, args.shadowmap)
+
+        for job in jobs:
+            if job["scene"] != scene_path:
+                continue
+
+            job_counter = perf_counter()
+            image = render_job(job, scene, not args.scalar, termination)
+            write_png(os.path.join(args.o, job["output"]), image, args.level)
+            print("%s %dx%d depth %d: %.3f s" % (job["output"], job["width"], job["height"], job["depth"], perf_counter() - job_counter))
+
+    print("Rendered %d jobs of %d scenes in %.3f s" % (len(jobs), len(scenes), perf_counter() - start_counter))
+
+if __name__ == '__main__':
+    main()
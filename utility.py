@@ -1,6 +1,5 @@
+import math
 import numpy as np
-import pygame
-from pygame.locals import *
 
 # treat sphere intersection as a quadratic function to solve, f = ax^2 + bx + c
 # https://en.wikipedia.org/wiki/Quadratic_equation#Quadratic_formula_and_its_derivation
@@ -33,6 +32,13 @@ def normalize(vec):
 def length(vec):
   return np.linalg.norm(vec)
 
+# normalizes every row of an (N, 3) array
+def normalize_batch(vecs):
+  return vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+
+def length_batch(vecs):
+  return np.linalg.norm(vecs, axis=1)
+
 def clamp(a, min_val, max_val):
   if (a < min_val): return min_val
   if (a > max_val): return max_val
@@ -46,28 +52,52 @@ def lerp(a, b, t):
 def reflect(vector, normal):
   return vector - 2*np.dot(vector,normal) * normal
 
-def progress_text(y_index, font, width, height):
-  percentage = ((y_index+1) / (height)) * 100
-  progress = "Progress: " +  "%.2f" % percentage + "%"
-  
-  color = (lerp(0, 255, y_index/(width-1)), 0, 255)
-  
-  text = font.render(progress, False, color, (0,0,0))
-  textrect = text.get_rect(left=10, top=50)
-  return (text, textrect)
+def reflect_batch(vectors, normals):
+  return vectors - 2*np.einsum('ij,ij->i', vectors, normals)[:, None] * normals
+
+# Plain float versions of the above for the scalar renderer (Ray.py), vectors are tuples of 3 floats.
+# For 3 components NumPy spends most of its time on the call itself and on allocating the result,
+# these don't allocate anything but the tuple they return. Compare them with: python benchmark.py -micro
+
+def vector3(vec):
+  return (float(vec[0]), float(vec[1]), float(vec[2]))
+
+def add3(a, b):
+  return (a[0] + b[0], a[1] + b[1], a[2] + b[2])
+
+def sub3(a, b):
+  return (a[0] - b[0], a[1] - b[1], a[2] - b[2])
+
+def scale3(vec, s):
+  return (vec[0] * s, vec[1] * s, vec[2] * s)
+
+def dot3(a, b):
+  return a[0]*b[0] + a[1]*b[1] + a[2]*b[2]
+
+def length3(vec):
+  return math.sqrt(vec[0]*vec[0] + vec[1]*vec[1] + vec[2]*vec[2])
 
-def print_camera_info(camera, font):
-  color = (255, 255, 255)
-  formatter = {'float_kind': lambda x: "%.2f" % x}
-  
-  position = np.array2string(camera.position, precision=4, separator=',', formatter=formatter)
-  look_to = np.array2string(camera.look_to, precision=4, separator=',', formatter=formatter)
+def normalize3(vec):
+  l = math.sqrt(vec[0]*vec[0] + vec[1]*vec[1] + vec[2]*vec[2])
+  return (vec[0] / l, vec[1] / l, vec[2] / l)
 
-  info = "Position: " + position + ", Looking at: " + look_to
+def reflect3(vector, normal):
+  k = 2 * (vector[0]*normal[0] + vector[1]*normal[1] + vector[2]*normal[2])
+  return (vector[0] - k * normal[0], vector[1] - k * normal[1], vector[2] - k * normal[2])
 
-  text = font.render(info, False, color, (0,0,0))
-  textpos = text.get_rect(left=0, top=0)
-  return (text, textpos)
+def solve_quadratic3(origin, direction, center, radius):
+  # solve_quadratic_equation for a ray origin, direction and a sphere center given as tuples
+  sx = origin[0] - center[0]
+  sy = origin[1] - center[1]
+  sz = origin[2] - center[2]
 
+  b = 2 * (direction[0]*sx + direction[1]*sy + direction[2]*sz)
+  c = sx*sx + sy*sy + sz*sz - radius*radius
+  discriminant = b*b - 4*c
 
+  if discriminant > 0:
+    d2 = (-b - math.sqrt(discriminant)) / 2 # d2 is the smaller solution, so d1 > 0.001 follows from d2 > 0.001
+    if d2 > 0.001:
+      return d2
 
+  return None